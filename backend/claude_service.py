@@ -1,51 +1,28 @@
+import asyncio
 import os
-from anthropic import Anthropic
+import re
+from string import Template
+from collections import OrderedDict
+from typing import AsyncIterator, Literal, Optional
+from anthropic import AsyncAnthropic
+import httpx
 import logging
+import orjson
+from pydantic import BaseModel, field_validator
+
+try:
+    from openai import AsyncOpenAI
+except ImportError:
+    AsyncOpenAI = None
+
+from llm_cache import LLMCache
 
 logger = logging.getLogger(__name__)
 
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+_MD_FENCE_RE = re.compile(r"^```(?:cypher)?\s*|\s*```$", re.MULTILINE)
 
-class ClaudeService:
-    def __init__(self):
-        # Check for force flag first
-        force_openai = os.getenv("_FORCE_OPENAI") == "true"
-        
-        # Check for API keys
-        openai_key = os.getenv("OPENAI_API_KEY")
-        anthropic_key = os.getenv("CLAUDE_API_KEY") or os.getenv("ANTHROPIC_API_KEY")
-        
-        # Determine which provider to use
-        if force_openai and openai_key:
-            self.use_openai = True
-            try:
-                from openai import OpenAI
-                self.client = OpenAI(api_key=openai_key)
-                logger.info("Using OpenAI API")
-            except ImportError:
-                raise ImportError("OpenAI library not installed. Please install with: pip install openai")
-        elif not force_openai and anthropic_key:
-            self.use_openai = False
-            self.client = Anthropic(api_key=anthropic_key)
-            logger.info("Using Anthropic Claude API")
-        elif openai_key:
-            self.use_openai = True
-            try:
-                from openai import OpenAI
-                self.client = OpenAI(api_key=openai_key)
-                logger.info("Using OpenAI API")
-            except ImportError:
-                raise ImportError("OpenAI library not installed. Please install with: pip install openai")
-        elif anthropic_key:
-            self.use_openai = False
-            self.client = Anthropic(api_key=anthropic_key)
-            logger.info("Using Anthropic Claude API")
-        else:
-            raise ValueError("No API key found. Please set OPENAI_API_KEY, CLAUDE_API_KEY, or ANTHROPIC_API_KEY")
-    
-    async def parse_visual_command(self, question: str) -> dict:
-        """Parse natural language into visual commands"""
-        
-        system_prompt = """You are a visual command parser for a 3D building viewer. 
+_VISUAL_SYSTEM_PROMPT = """You are a visual command parser for a 3D building viewer. 
 Parse natural language requests into structured visual commands.
 
 Available command types:
@@ -91,87 +68,14 @@ Important:
 - Parse element types in both Japanese and English
 - Always include a friendly message explaining what was done"""
 
-        user_prompt = f"""Parse this request: "{question}"
+_VISUAL_USER_TEMPLATE = """Parse this request: "{question}"
 
 If it's a visual command, return the structured command.
 If not a visual command, return has_command: false.
 
 Response must be valid JSON."""
 
-        try:
-            if self.use_openai:
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    max_tokens=500,
-                    temperature=0,
-                    response_format={ "type": "json_object" },
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
-                result = response.choices[0].message.content.strip()
-            else:
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=500,
-                    temperature=0,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
-                result = response.content[0].text.strip()
-            
-            # Parse JSON response
-            import json
-            parsed = json.loads(result)
-            
-            # Convert Japanese colors to hex if needed
-            if parsed.get("has_command") and parsed.get("command", {}).get("color"):
-                color = parsed["command"]["color"]
-                color_map = {
-                    "赤": "#ff0000",
-                    "緑": "#00ff00", 
-                    "青": "#0000ff",
-                    "黄": "#ffff00",
-                    "白": "#ffffff",
-                    "黒": "#000000",
-                    "灰": "#808080",
-                    "茶": "#8b4513",
-                    "ピンク": "#ffc0cb",
-                    "オレンジ": "#ffa500",
-                    "紫": "#800080",
-                    "red": "#ff0000",
-                    "green": "#00ff00",
-                    "blue": "#0000ff",
-                    "yellow": "#ffff00",
-                    "white": "#ffffff",
-                    "black": "#000000",
-                    "gray": "#808080",
-                    "grey": "#808080",
-                    "brown": "#8b4513",
-                    "pink": "#ffc0cb",
-                    "orange": "#ffa500",
-                    "purple": "#800080"
-                }
-                if color.lower() in color_map:
-                    parsed["command"]["color"] = color_map[color.lower()]
-            
-            logger.info(f"Parsed visual command: {parsed}")
-            return parsed
-            
-        except Exception as e:
-            logger.error(f"Error parsing visual command: {e}")
-            return {
-                "has_command": False,
-                "message": "コマンドの解析に失敗しました"
-            }
-    
-    async def generate_cypher(self, question: str, session_id: str) -> str:
-        """Generate Cypher query from natural language question"""
-        
-        system_prompt = """You are an expert Cypher query generator for a Neo4j database containing IFC (Industry Foundation Classes) building model data.
+_CYPHER_SYSTEM_PROMPT = """You are an expert Cypher query generator for a Neo4j database containing IFC (Industry Foundation Classes) building model data.
 
 The database contains these node types with their properties:
 - IfcBuilding: Building entities (guid, name, session_id, description)
@@ -188,6 +92,8 @@ The database contains these node types with their properties:
 - IfcElement: Generic label for all building elements (guid, name, session_id, description, element_type)
 - IfcMaterial: Material nodes (name, description, session_id)
 - IfcMaterialLayerSet: Material layer sets (name, session_id)
+- IfcNode: Extra label on every node above that has a guid; match (n:IfcNode) for "all elements"
+- IfcSession: One summary node per session (session_id, building_info); it is not a building element
 
 The relationships are:
 - (IfcBuilding)-[:CONTAINS_STOREY]->(IfcBuildingStorey)
@@ -203,9 +109,8 @@ CRITICAL REQUIREMENTS:
 2. Generate ONLY the Cypher query with no explanations or markdown formatting
 3. Return meaningful property names in results
 4. Handle both English and Japanese questions
-5. Use appropriate aggregation functions (count, sum, etc.) when needed"""
-
-        user_prompt = f"""Generate a Cypher query for this question: "{question}"
+5. Use appropriate aggregation functions (count, sum, etc.) when needed
+6. Never MATCH a bare (n): use (n:IfcNode) or a specific label so IfcSession is excluded, and drop 'IfcNode' from labels(n) in results
 
 EXAMPLES:
 - "何階建てですか？" / "How many floors?" 
@@ -295,86 +200,57 @@ EXAMPLES:
 - "多層材質は？" / "Layered materials"
   -> MATCH (mls:IfcMaterialLayerSet) WHERE mls.session_id = $session_id RETURN mls.name as layerset_name"""
 
-        try:
-            if self.use_openai:
-                # OpenAI API call
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    max_tokens=1000,
-                    temperature=0,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
-                cypher_query = response.choices[0].message.content.strip()
-            else:
-                # Anthropic Claude API call
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=1000,
-                    temperature=0,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
-                cypher_query = response.content[0].text.strip()
-            
-            # Clean up the response - remove any markdown formatting
-            if cypher_query.startswith("```"):
-                lines = cypher_query.split('\n')
-                cypher_query = '\n'.join(line for line in lines if not line.startswith("```"))
-                cypher_query = cypher_query.strip()
-            
-            # Validate that the query contains session_id filter
-            if "session_id = $session_id" not in cypher_query:
-                logger.warning("Generated query missing session_id filter, adding it")
-                # Try to add session_id filter automatically
-                if "WHERE" in cypher_query:
-                    cypher_query = cypher_query.replace("WHERE", "WHERE session_id = $session_id AND")
-                else:
-                    # Find the MATCH clause and add WHERE after it
-                    if "MATCH" in cypher_query and "RETURN" in cypher_query:
-                        match_part, return_part = cypher_query.split("RETURN", 1)
-                        cypher_query = f"{match_part} WHERE session_id = $session_id RETURN{return_part}"
-            
-            logger.info(f"Generated Cypher query: {cypher_query}")
-            return cypher_query
-            
-        except Exception as e:
-            logger.error(f"Error generating Cypher query: {e}")
-            # Smart fallback based on question content
-            question_lower = question.lower()
-            if any(word in question_lower for word in ['何階', 'floor', '階数']):
-                return "MATCH (s:IfcBuildingStorey) WHERE s.session_id = $session_id RETURN count(s) as floor_count"
-            elif any(word in question_lower for word in ['部屋', 'room', 'space']):
-                return "MATCH (sp:IfcSpace) WHERE sp.session_id = $session_id RETURN count(sp) as room_count"
-            elif any(word in question_lower for word in ['窓', 'window']):
-                return "MATCH (w:IfcWindow) WHERE w.session_id = $session_id RETURN count(w) as window_count"
-            elif any(word in question_lower for word in ['ドア', 'door']):
-                return "MATCH (d:IfcDoor) WHERE d.session_id = $session_id RETURN count(d) as door_count"
-            elif any(word in question_lower for word in ['家具', 'furniture']):
-                return "MATCH (f:IfcFurnishingElement) WHERE f.session_id = $session_id RETURN count(f) as furniture_count"
-            elif any(word in question_lower for word in ['壁', 'wall']):
-                return "MATCH (w:IfcWall) WHERE w.session_id = $session_id RETURN count(w) as wall_count"
-            elif any(word in question_lower for word in ['柱', 'column']):
-                return "MATCH (c:IfcColumn) WHERE c.session_id = $session_id RETURN count(c) as column_count"
-            elif any(word in question_lower for word in ['材質', '材料', 'material']):
-                return "MATCH (m:IfcMaterial) WHERE m.session_id = $session_id RETURN m.name as material_name"
-            elif any(word in question_lower for word in ['コンクリート', 'concrete']):
-                return "MATCH (e)-[:HAS_MATERIAL]->(m:IfcMaterial) WHERE e.session_id = $session_id AND m.name CONTAINS 'Concrete' RETURN e.element_type as element_type, count(e) as count"
-            elif any(word in question_lower for word in ['木', '木材', 'wood', 'timber']):
-                return "MATCH (e)-[:HAS_MATERIAL]->(m:IfcMaterial) WHERE e.session_id = $session_id AND (m.name CONTAINS 'Wood' OR m.name CONTAINS '木' OR m.name CONTAINS 'Timber') RETURN e.element_type as element_type, count(e) as count"
-            elif any(word in question_lower for word in ['鋼', '金属', 'steel', 'metal']):
-                return "MATCH (e)-[:HAS_MATERIAL]->(m:IfcMaterial) WHERE e.session_id = $session_id AND (m.name CONTAINS 'Steel' OR m.name CONTAINS 'Metal' OR m.name CONTAINS '鋼' OR m.name CONTAINS 'Aluminum') RETURN e.element_type as element_type, count(e) as count"
-            else:
-                return "MATCH (n) WHERE n.session_id = $session_id RETURN labels(n) as type, count(n) as count ORDER BY count DESC"
-    
-    async def generate_natural_response(self, question: str, query_result: list, conversation_history: list = None) -> str:
-        """Generate a natural language response from query results"""
-        
-        system_prompt = """あなたは建築・BIM分野の専門知識を持つAI建築コンサルタントです。親しみやすく、でも専門性のある会話で、建物のデータから価値ある洞察を提供してください。
+# Generated Cypher is a single short query; stop at the first blank line
+_CYPHER_MAX_TOKENS = 400
+_CYPHER_STOP_SEQUENCES = ["\n\n"]
+_CYPHER_USER_TEMPLATE = 'Generate a Cypher query for this question: "{question}"'
+
+# Interactive Cypher generation goes through tools: simple count/list questions
+# come back as a small structured spec that is assembled into Cypher locally,
+# everything else as a complete query. The label list is fixed (not per session)
+# so the tool definitions stay part of the shared cached prefix.
+_QUERYABLE_LABELS = [
+    "IfcBuilding", "IfcBuildingStorey", "IfcSpace", "IfcDoor", "IfcWindow",
+    "IfcBuildingElementProxy", "IfcFurnishingElement", "IfcWall", "IfcSlab", "IfcColumn",
+    "IfcBeam", "IfcRoof", "IfcStair", "IfcRailing", "IfcCurtainWall", "IfcPlate", "IfcMember",
+    "IfcRamp", "IfcFooting", "IfcPile", "IfcElement", "IfcMaterial",
+]
+_CYPHER_TOOLS = [
+    {
+        "name": "query_elements",
+        "description": "Count or list the nodes of one type, optionally filtered by name and by the floor they are on. Use this whenever the question is about a single node type.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "label": {"type": "string", "enum": _QUERYABLE_LABELS},
+                "aggregation": {"type": "string", "enum": ["count", "list"]},
+                "name_contains": {"type": "string", "description": "Only nodes whose name contains this text"},
+                "floor_name_contains": {"type": "string", "description": "Only nodes on storeys whose name contains this text"},
+            },
+            "required": ["label", "aggregation"],
+        },
+    },
+    {
+        "name": "cypher",
+        "description": "Any other question: a complete Cypher query that follows the requirements in the system prompt.",
+        "input_schema": {
+            "type": "object",
+            "properties": {"query": {"type": "string"}},
+            "required": ["query"],
+        },
+    },
+]
+_OPENAI_CYPHER_TOOLS = [
+    {"type": "function", "function": {"name": t["name"], "description": t["description"], "parameters": t["input_schema"]}}
+    for t in _CYPHER_TOOLS
+]
+# Per-session block sent between the shared system prompt and the question, so
+# it is cached once per session
+_SESSION_SUMMARY_TEMPLATE = """The model in this session has {floor_count} floors, {space_count} spaces and {material_count} materials.
+Node types present, with counts:
+{node_types}"""
+
+_NATURAL_SYSTEM_PROMPT = """あなたは建築・BIM分野の専門知識を持つAI建築コンサルタントです。親しみやすく、でも専門性のある会話で、建物のデータから価値ある洞察を提供してください。
 
 専門分野での対応能力：
 ・建築専門知識による解釈・提案: 建物の用途推定、設計意図の分析、改善提案
@@ -391,21 +267,14 @@ EXAMPLES:
 ・建設業界の実務に役立つ価値ある情報を提供する
 ・専門用語は使うが、わかりやすく説明を加える"""
 
-        # 会話履歴を構築
-        conversation_context = ""
-        if conversation_history and len(conversation_history) > 0:
-            conversation_context = "\n会話履歴:\n"
-            for i, msg in enumerate(conversation_history[-6:]):  # 最新6件の履歴のみ使用
-                role = "ユーザー" if msg.get('type') == 'user' else "AI"
-                conversation_context += f"{role}: {msg.get('content', '')}\n"
-            conversation_context += "\n"
-
-        user_prompt = f"""ユーザーの質問: "{question}"
-
-{conversation_context}データベースから取得したデータ:
-{query_result}
+# 最新6件の履歴のみ使用
+_HISTORY_WINDOW = 6
+# Approximate token budget for the history block; long AI analyses are dropped oldest first
+_HISTORY_TOKEN_BUDGET = 2000
+_HISTORY_CACHE_SESSIONS = 1024
 
-このデータを基に、AI建築コンサルタントとして専門的で価値ある分析と提案を、親しみやすい会話調で回答してください。
+# Static answer instructions, sent ahead of the per-request data so they extend the cached prefix
+_NATURAL_INSTRUCTIONS = """後に続く質問とデータを基に、AI建築コンサルタントとして専門的で価値ある分析と提案を、親しみやすい会話調で回答してください。
 
 重要な制約：
 ・マークダウンの太字記号（**）や箇条書き記号（-、•、1.、2.など）は絶対に使わない
@@ -421,34 +290,894 @@ EXAMPLES:
 
 例：「2階建てで8つの部屋があって、窓が42個もあるんですね。これだけ窓が多いということは、自然採光を重視した設計思想が見て取れます。省エネルギーの観点からも優秀で、照明コストの削減効果が期待できそうです。ただ、熱負荷の管理が重要になってくるので、断熱性能やブラインドシステムの検討をお勧めします。オフィスビルとしての利用なら、快適な作業環境が実現できると思います」"""
 
-        try:
+_NL_USER_TEMPLATE = """ユーザーの質問: "{question}"
+
+{conversation_context}データベースから取得したデータ:
+{query_result}"""
+
+NATURAL_RESPONSE_ERROR = "申し訳ございませんが、その情報を取得できませんでした。"
+
+
+class IncompleteResponseError(Exception):
+    """Raised after a streamed response that stopped at max_tokens, so its text is cut off"""
+
+_COLOR_MAP = {
+    "赤": "#ff0000",
+    "緑": "#00ff00",
+    "青": "#0000ff",
+    "黄": "#ffff00",
+    "白": "#ffffff",
+    "黒": "#000000",
+    "灰": "#808080",
+    "茶": "#8b4513",
+    "ピンク": "#ffc0cb",
+    "オレンジ": "#ffa500",
+    "紫": "#800080",
+    "red": "#ff0000",
+    "green": "#00ff00",
+    "blue": "#0000ff",
+    "yellow": "#ffff00",
+    "white": "#ffffff",
+    "black": "#000000",
+    "gray": "#808080",
+    "grey": "#808080",
+    "brown": "#8b4513",
+    "pink": "#ffc0cb",
+    "orange": "#ffa500",
+    "purple": "#800080"
+}
+_COLOR_MAP_LOWER = {k.lower(): v for k, v in _COLOR_MAP.items()}
+
+
+class CommandTarget(BaseModel):
+    elementType: Optional[str] = None
+    elementName: Optional[str] = None
+    material: Optional[str] = None
+    floor: Optional[str] = None
+
+
+class CommandDetail(BaseModel):
+    type: Literal["color", "visibility", "highlight", "isolate", "reset", "camera", "transparency"]
+    target: Optional[CommandTarget] = None
+    color: Optional[str] = None
+    action: Optional[str] = None
+    opacity: Optional[float] = None
+    aspect: Optional[str] = None
+
+    @field_validator("color")
+    @classmethod
+    def normalize_color(cls, v: Optional[str]) -> Optional[str]:
+        # Convert Japanese/English color names to hex
+        if v is None:
+            return v
+        return _COLOR_MAP_LOWER.get(v.lower(), v)
+
+
+class VisualCommand(BaseModel):
+    has_command: bool
+    command: Optional[CommandDetail] = None
+    message: Optional[str] = None
+
+
+def _parse_visual_command_json(result: str) -> dict:
+    return VisualCommand.model_validate_json(result).model_dump(exclude_none=True)
+
+# Element keyword -> viewer elementType, used by the local visual-command fast path
+_ELEMENT_MAP = {
+    "壁": "Wall",
+    "wall": "Wall",
+    "walls": "Wall",
+    "窓": "Window",
+    "window": "Window",
+    "windows": "Window",
+    "ドア": "Door",
+    "door": "Door",
+    "doors": "Door",
+    "床": "Slab",
+    "slab": "Slab",
+    "slabs": "Slab",
+    "柱": "Column",
+    "column": "Column",
+    "columns": "Column"
+}
+
+
+def _alternation(words) -> str:
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+# Only unambiguous one-shot phrases are handled locally; anything else goes to the LLM
+_FAST_RESET_RE = re.compile(r"^\s*(?:リセット|reset)(?:して(?:ください)?|する|\s+(?:the\s+)?view)?[。.!！]?\s*$", re.IGNORECASE)
+_FAST_COLOR_RE = re.compile(
+    rf"^\s*(?P<element>{_alternation(_ELEMENT_MAP)})(?:の色)?を(?P<color>{_alternation(_COLOR_MAP)})(?:色)?に(?:して|変えて|変更して)(?:ください)?[。!！]?\s*$"
+    rf"|^\s*(?:make|color|paint)\s+(?:the\s+|all\s+)?(?P<element_en>{_alternation(_ELEMENT_MAP)})\s+(?P<color_en>{_alternation(_COLOR_MAP)})[.!]?\s*$",
+    re.IGNORECASE
+)
+
+# Keyword -> Cypher fallback used when the LLM call fails, checked in order
+_FALLBACK_KEYWORDS = [
+    (frozenset({"何階", "floor", "階数"}),
+     "MATCH (s:IfcBuildingStorey) WHERE s.session_id = $session_id RETURN count(s) as floor_count"),
+    (frozenset({"部屋", "room", "space"}),
+     "MATCH (sp:IfcSpace) WHERE sp.session_id = $session_id RETURN count(sp) as room_count"),
+    (frozenset({"窓", "window"}),
+     "MATCH (w:IfcWindow) WHERE w.session_id = $session_id RETURN count(w) as window_count"),
+    (frozenset({"ドア", "door"}),
+     "MATCH (d:IfcDoor) WHERE d.session_id = $session_id RETURN count(d) as door_count"),
+    (frozenset({"家具", "furniture"}),
+     "MATCH (f:IfcFurnishingElement) WHERE f.session_id = $session_id RETURN count(f) as furniture_count"),
+    (frozenset({"壁", "wall"}),
+     "MATCH (w:IfcWall) WHERE w.session_id = $session_id RETURN count(w) as wall_count"),
+    (frozenset({"柱", "column"}),
+     "MATCH (c:IfcColumn) WHERE c.session_id = $session_id RETURN count(c) as column_count"),
+    (frozenset({"材質", "材料", "material"}),
+     "MATCH (m:IfcMaterial) WHERE m.session_id = $session_id RETURN m.name as material_name"),
+    (frozenset({"コンクリート", "concrete"}),
+     "MATCH (e)-[:HAS_MATERIAL]->(m:IfcMaterial) WHERE e.session_id = $session_id AND m.name CONTAINS 'Concrete' RETURN e.element_type as element_type, count(e) as count"),
+    (frozenset({"木", "木材", "wood", "timber"}),
+     "MATCH (e)-[:HAS_MATERIAL]->(m:IfcMaterial) WHERE e.session_id = $session_id AND (m.name CONTAINS 'Wood' OR m.name CONTAINS '木' OR m.name CONTAINS 'Timber') RETURN e.element_type as element_type, count(e) as count"),
+    (frozenset({"鋼", "金属", "steel", "metal"}),
+     "MATCH (e)-[:HAS_MATERIAL]->(m:IfcMaterial) WHERE e.session_id = $session_id AND (m.name CONTAINS 'Steel' OR m.name CONTAINS 'Metal' OR m.name CONTAINS '鋼' OR m.name CONTAINS 'Aluminum') RETURN e.element_type as element_type, count(e) as count"),
+]
+# All keyword groups in one pattern, one named group per table row. The lookahead
+# makes matches zero-width so a long keyword never hides a shorter one inside it.
+_FALLBACK_RE = re.compile(
+    "(?=" + "|".join(f"(?P<k{i}>{_alternation(keywords)})" for i, (keywords, _) in enumerate(_FALLBACK_KEYWORDS)) + ")",
+    re.IGNORECASE
+)
+_FALLBACK_QUERIES = [query for _, query in _FALLBACK_KEYWORDS]
+_FALLBACK_DEFAULT_QUERY = "MATCH (n:IfcNode) WHERE n.session_id = $session_id RETURN [label IN labels(n) WHERE label <> 'IfcNode'] as type, count(n) as count ORDER BY count DESC"
+
+# Bare "how many X" questions that the fallback table already answers exactly.
+# Anything with a qualifier (floor, material, room name, ...) still goes to the LLM.
+_DIRECT_COUNT_JA = ["部屋", "窓", "ドア", "家具", "壁", "柱"]
+_DIRECT_COUNT_EN = ["rooms", "spaces", "windows", "doors", "furniture", "walls", "columns", "floors"]
+_DIRECT_COUNT_RE = re.compile(
+    rf"^\s*(?:(?:{_alternation(_DIRECT_COUNT_JA)})の?(?:数|総数|個数)(?:は|を教えて(?:ください)?)?|何階建て(?:ですか)?)[？?。]?\s*$"
+    rf"|^\s*how\s+many\s+(?:{_alternation(_DIRECT_COUNT_EN)})(?:\s+are\s+there)?\s*[?.]?\s*$",
+    re.IGNORECASE
+)
+
+# Fixed queries for the suggested questions from analyze_ifc_capabilities_with_ai,
+# which are sent verbatim and so never need the LLM
+_OVERVIEW_CYPHER = "MATCH (n:IfcNode) WHERE n.session_id = $session_id RETURN coalesce(n.element_type, [label IN labels(n) WHERE label <> 'IfcNode'][0]) as element_type, count(n) as count ORDER BY count DESC"
+_FURNITURE_BY_FLOOR_CYPHER = "MATCH (s:IfcBuildingStorey) WHERE s.session_id = $session_id OPTIONAL MATCH (s)-[:CONTAINS|CONTAINS_SPACE*1..2]->(f:IfcFurnishingElement) RETURN s.name as floor, s.elevation as elevation, count(DISTINCT f) as furniture_count, collect(DISTINCT f.name)[..20] as furniture_names ORDER BY elevation"
+_SPACES_BY_FLOOR_CYPHER = "MATCH (s:IfcBuildingStorey)-[:CONTAINS_SPACE]->(sp:IfcSpace) WHERE s.session_id = $session_id RETURN s.name as floor, sp.name as room_name, sp.description as description ORDER BY s.elevation"
+_OPENINGS_CYPHER = "MATCH (w:IfcWindow) WHERE w.session_id = $session_id WITH count(w) as windows MATCH (d:IfcDoor) WHERE d.session_id = $session_id RETURN windows, count(d) as doors"
+_QUESTION_TO_CYPHER = {
+    **dict.fromkeys([
+        "この建物の基本構成を分析してください",
+        "エネルギー効率と省エネ性能を評価してください",
+        "建築基準法・法規制への適合性をチェック",
+        "設計の改善提案をお願いします",
+        "コスト分析と投資効果を評価",
+        "空間利用の最適化について提案",
+        "建物の用途と設計意図を分析",
+        "維持管理・運用面での提案",
+        "構造要素の配置と効率性",
+        "耐震性能の評価",
+    ], _OVERVIEW_CYPHER),
+    **dict.fromkeys([
+        "1階の家具の数と配置について",
+        "2階の家具の数と配置について",
+        "家具レイアウトの最適化提案",
+    ], _FURNITURE_BY_FLOOR_CYPHER),
+    **dict.fromkeys(["各空間の用途別分析", "動線計画の評価と改善"], _SPACES_BY_FLOOR_CYPHER),
+    **dict.fromkeys(["自然採光と通風の効率性", "開口部の配置最適化"], _OPENINGS_CYPHER),
+}
+
+# Nouns that can be swapped in a question without changing the shape of its
+# Cypher query: noun -> (node label, English stem used in result aliases).
+# Rooms are left out: spaces hang off CONTAINS_SPACE, elements off CONTAINS.
+_CYPHER_ENTITIES = {
+    "窓": ("IfcWindow", "window"),
+    "ドア": ("IfcDoor", "door"),
+    "壁": ("IfcWall", "wall"),
+    "柱": ("IfcColumn", "column"),
+    "家具": ("IfcFurnishingElement", "furniture"),
+}
+_CYPHER_ENTITY_RE = re.compile(_alternation(_CYPHER_ENTITIES))
+_CYPHER_LABEL_RES = {label: re.compile(rf"\b{label}\b") for label, _ in _CYPHER_ENTITIES.values()}
+# Traversals depend on where the entity sits in the graph, so they are never templated
+_CYPHER_RELATIONSHIP_RE = re.compile(r"-\[|<-|->|--")
+_SKELETON_TRIM = " 　?？。.!！"
+# Versioned so templates cached before traversals were excluded are never read back
+_SKELETON_KEY_PREFIX = "skeleton:v2:"
+
+
+def _cypher_user_prompt(question: str) -> str:
+    return _CYPHER_USER_TEMPLATE.format(question=question)
+
+
+def _session_summary_prompt(summary: Optional[dict]) -> Optional[str]:
+    """Format the parse-time IfcSession summary as a stable prompt block"""
+    if not summary:
+        return None
+    all_elements = orjson.loads(summary.get("building_info") or "{}").get("all_elements", [])
+    return _SESSION_SUMMARY_TEMPLATE.format(
+        floor_count=summary.get("floor_count", 0),
+        space_count=summary.get("space_count", 0),
+        material_count=summary.get("material_count", 0),
+        node_types="\n".join(f"- {elem['labels'][0]}: {elem['count']}" for elem in all_elements)
+    )
+
+
+def _cypher_string(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _structured_cypher(spec: dict) -> str:
+    """Assemble the query for a query_elements tool call"""
+    label = spec["label"]
+    if label not in _QUERYABLE_LABELS:
+        raise ValueError(f"Unknown label in structured query: {label}")
+    if spec.get("floor_name_contains"):
+        query = (f"MATCH (s:IfcBuildingStorey)-[:CONTAINS|CONTAINS_SPACE*1..2]->(e:{label}) "
+                 f"WHERE s.session_id = $session_id AND s.name CONTAINS {_cypher_string(spec['floor_name_contains'])}")
+    else:
+        query = f"MATCH (e:{label}) WHERE e.session_id = $session_id"
+    if spec.get("name_contains"):
+        query += f" AND e.name CONTAINS {_cypher_string(spec['name_contains'])}"
+    if spec["aggregation"] == "count":
+        return query + " RETURN count(DISTINCT e) as count"
+    return query + " RETURN DISTINCT e.name as name, e.description as description"
+
+
+def _tool_cypher(name: str, arguments: dict) -> str:
+    if name == "query_elements":
+        return _structured_cypher(arguments)
+    return arguments["query"]
+
+
+def _clean_cypher(cypher_query: str) -> str:
+    """Strip markdown formatting and make sure the query is scoped to the session"""
+    # Clean up the response - remove any markdown formatting
+    if cypher_query.startswith("```"):
+        cypher_query = _MD_FENCE_RE.sub("", cypher_query).strip()
+    
+    # Validate that the query contains session_id filter
+    if "session_id = $session_id" not in cypher_query:
+        logger.warning("Generated query missing session_id filter, adding it")
+        # Try to add session_id filter automatically
+        if "WHERE" in cypher_query:
+            cypher_query = cypher_query.replace("WHERE", "WHERE session_id = $session_id AND")
+        else:
+            # Find the MATCH clause and add WHERE after it
+            if "MATCH" in cypher_query and "RETURN" in cypher_query:
+                match_part, return_part = cypher_query.split("RETURN", 1)
+                cypher_query = f"{match_part} WHERE session_id = $session_id RETURN{return_part}"
+    
+    return cypher_query
+
+
+def _cypher_skeleton(question: str) -> Optional[tuple]:
+    """Reduce a question naming exactly one swappable entity to (skeleton, noun).
+
+    Digits are left in place: floor numbers change the predicates of the query
+    (e.g. ground floor matches on elevation = 0), not just a literal.
+    """
+    nouns = _CYPHER_ENTITY_RE.findall(question)
+    if len(nouns) != 1:
+        return None
+    skeleton = _CYPHER_ENTITY_RE.sub("<ENTITY>", question.strip(_SKELETON_TRIM).lower())
+    return skeleton, nouns[0]
+
+
+def _cypher_template(cypher_query: str, noun: str) -> Optional[str]:
+    """Turn a generated query into a template with $entity/$noun placeholders, if it is safe to reuse"""
+    label, stem = _CYPHER_ENTITIES[noun]
+    if not _CYPHER_LABEL_RES[label].search(cypher_query) or _CYPHER_RELATIONSHIP_RE.search(cypher_query):
+        return None
+    if any(pattern.search(cypher_query) for other, pattern in _CYPHER_LABEL_RES.items() if other != label):
+        return None
+    template = _CYPHER_LABEL_RES[label].sub("${entity}", cypher_query)
+    return re.sub(rf"\b{stem}", "${noun}", template)
+
+
+def _fill_cypher_template(template: str, noun: str) -> str:
+    label, stem = _CYPHER_ENTITIES[noun]
+    # safe_substitute leaves query parameters such as $session_id untouched
+    return Template(template).safe_substitute(entity=label, noun=stem)
+
+
+def _direct_cypher(question: str) -> Optional[str]:
+    """Precomputed query for a suggested or bare count question, or None if the LLM is needed"""
+    canned = _QUESTION_TO_CYPHER.get(question.strip())
+    if canned is not None:
+        return canned
+    if _DIRECT_COUNT_RE.match(question):
+        return _fallback_cypher(question)
+    return None
+
+
+def _fallback_cypher(question: str) -> str:
+    """Pick a Cypher query from the keyword table when the LLM is unavailable"""
+    # Single scan; the earliest table row that matched anywhere wins
+    rows = {int(match.lastgroup[1:]) for match in _FALLBACK_RE.finditer(question) if match.lastgroup}
+    return _FALLBACK_QUERIES[min(rows)] if rows else _FALLBACK_DEFAULT_QUERY
+
+
+def _visual_user_prompt(question: str) -> str:
+    return _VISUAL_USER_TEMPLATE.format(question=question)
+
+
+def _fast_visual_command(question: str) -> Optional[dict]:
+    """Build reset/color commands for trivial phrasings without calling the LLM"""
+    if _FAST_RESET_RE.match(question):
+        return {
+            "has_command": True,
+            "command": {"type": "reset", "aspect": "all"},
+            "message": "表示をリセットしました"
+        }
+    match = _FAST_COLOR_RE.match(question)
+    if match:
+        if match.group("element"):
+            element, color = match.group("element"), match.group("color")
+            message = f"{element}を{color}色に変更しました"
+        else:
+            element, color = match.group("element_en"), match.group("color_en")
+            message = f"Changed the {element.lower()} to {color.lower()}"
+        return {
+            "has_command": True,
+            "command": {
+                "type": "color",
+                "target": {"elementType": _ELEMENT_MAP[element.lower()]},
+                "color": _COLOR_MAP_LOWER[color.lower()]
+            },
+            "message": message
+        }
+    return None
+
+
+def _estimate_tokens(text: str) -> int:
+    """Cheap local token estimate: ~1 token per non-ASCII (Japanese) char, ~4 ASCII chars per token"""
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (len(text) - ascii_chars) + ascii_chars // 4
+
+
+def _budget_history(lines: list, budget: int = _HISTORY_TOKEN_BUDGET) -> list:
+    """Keep the newest history lines that fit the token budget (always at least the last one)"""
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        used += _estimate_tokens(line)
+        if kept and used > budget:
+            break
+        kept.append(line)
+    kept.reverse()
+    return kept
+
+
+def _format_history_line(msg: dict) -> str:
+    role = "ユーザー" if msg.get('type') == 'user' else "AI"
+    return f"{role}: {msg.get('content', '')}\n"
+
+
+def _cacheable_system(text: str) -> list:
+    """Wrap a static system prompt so Anthropic caches it as a prompt prefix"""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+def _user_content(user: str, user_prefix: Optional[str]):
+    """Anthropic user content with an optional static prefix block marked for caching"""
+    if not user_prefix:
+        return user
+    return [
+        {"type": "text", "text": user_prefix, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": user}
+    ]
+
+
+# SDK-level retries with exponential backoff (covers 429 rate limit responses)
+_LLM_MAX_RETRIES = 4
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _make_http_client() -> httpx.AsyncClient:
+    """Shared HTTP/2 connection pool for the provider SDK clients.
+
+    Created once per process and reused when the service is rebuilt (e.g. on a
+    provider switch), so warm TCP/TLS connections are kept instead of leaked.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            # httpx ignores the client's limits when a transport is given, so they go on the transport
+            transport=httpx.AsyncHTTPTransport(
+                retries=2, http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared provider connection pool (call on application shutdown)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _make_openai_client(api_key: str, http_client: httpx.AsyncClient):
+    if AsyncOpenAI is None:
+        raise ImportError("OpenAI library not installed. Please install with: pip install openai")
+    return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=_LLM_MAX_RETRIES)
+
+
+def _make_anthropic_client(api_key: str, http_client: httpx.AsyncClient):
+    return AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=_LLM_MAX_RETRIES)
+
+
+_MODELS = {
+    "openai": "gpt-4o",
+    "anthropic": "claude-3-5-sonnet-20241022",
+}
+
+# Cypher output is short and mostly determined by the examples, so a smaller tier suffices
+_CYPHER_MODELS = {
+    "openai": "gpt-4o-mini",
+    "anthropic": "claude-3-5-haiku-20241022",
+}
+
+# provider -> (client factory, log label)
+_PROVIDERS = {
+    "openai": (_make_openai_client, "OpenAI API"),
+    "anthropic": (_make_anthropic_client, "Anthropic Claude API"),
+}
+
+
+class ClaudeService:
+    def __init__(self):
+        # Check for force flag first
+        force_openai = os.getenv("_FORCE_OPENAI") == "true"
+        
+        # Check for API keys
+        openai_key = os.getenv("OPENAI_API_KEY")
+        anthropic_key = os.getenv("CLAUDE_API_KEY") or os.getenv("ANTHROPIC_API_KEY")
+        
+        # Determine which provider to use
+        if force_openai and openai_key:
+            provider, api_key = "openai", openai_key
+        elif anthropic_key:
+            provider, api_key = "anthropic", anthropic_key
+        elif openai_key:
+            provider, api_key = "openai", openai_key
+        else:
+            raise ValueError("No API key found. Please set OPENAI_API_KEY, CLAUDE_API_KEY, or ANTHROPIC_API_KEY")
+        
+        make_client, label = _PROVIDERS[provider]
+        self.provider = provider
+        self.use_openai = provider == "openai"
+        self.model = _MODELS[provider]
+        self.cypher_model = _CYPHER_MODELS[provider]
+        self.client = make_client(api_key, _make_http_client())
+        logger.info(f"Using {label}")
+        
+        # Bound in-flight LLM calls so fan-out stays under the provider rate limit
+        self._gate = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "20")))
+        
+        # Cache for deterministic (temperature=0) calls
+        self.cache = LLMCache(redis_url=os.getenv("REDIS_URL"))
+        # session_id -> (history length, formatted tail lines)
+        self._history_cache: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    def _request(self, system: str, user: str, *, max_tokens: int, temperature: float,
+                 user_prefix: Optional[str] = None, model: Optional[str] = None) -> dict:
+        """Provider-specific create() arguments for one system + user exchange.
+
+        A static ``user_prefix`` is sent before ``user`` and, for Anthropic,
+        marked as part of the cached prompt prefix.
+        """
+        request = {"model": model or self.model, "max_tokens": max_tokens, "temperature": temperature}
+        if self.use_openai:
+            request["messages"] = [
+                {"role": "system", "content": system},
+                {"role": "user", "content": f"{user_prefix}\n\n{user}" if user_prefix else user}
+            ]
+        else:
+            request["system"] = _cacheable_system(system)
+            request["messages"] = [
+                {"role": "user", "content": _user_content(user, user_prefix)}
+            ]
+        return request
+    
+    async def _chat(self, system: str, user: str, *, max_tokens: int, temperature: float,
+                    response_format: Optional[dict] = None, stop: Optional[list] = None,
+                    user_prefix: Optional[str] = None, model: Optional[str] = None) -> str:
+        """Send one system + user exchange to the active provider and return the stripped text"""
+        request = self._request(system, user, max_tokens=max_tokens, temperature=temperature,
+                                user_prefix=user_prefix, model=model)
+        async with self._gate:
             if self.use_openai:
                 # OpenAI API call
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    max_tokens=1000,
-                    temperature=0.5,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
-                natural_response = response.choices[0].message.content.strip()
+                if response_format:
+                    request["response_format"] = response_format
+                if stop:
+                    request["stop"] = stop
+                response = await self.client.chat.completions.create(**request)
+                return response.choices[0].message.content.strip()
+            
+            # Anthropic Claude API call
+            if stop:
+                request["stop_sequences"] = stop
+            response = await self.client.messages.create(**request)
+            return response.content[0].text.strip()
+    
+    async def _chat_stream(self, system: str, user: str, *, max_tokens: int, temperature: float,
+                           response_format: Optional[dict] = None,
+                           user_prefix: Optional[str] = None,
+                           model: Optional[str] = None) -> AsyncIterator[str]:
+        """Streaming variant of _chat that yields text chunks as they arrive.
+
+        Raises IncompleteResponseError after the last chunk if the model hit max_tokens.
+        """
+        request = self._request(system, user, max_tokens=max_tokens, temperature=temperature,
+                                user_prefix=user_prefix, model=model)
+        async with self._gate:
+            if self.use_openai:
+                # OpenAI API call
+                if response_format:
+                    request["response_format"] = response_format
+                stream = await self.client.chat.completions.create(stream=True, **request)
+                stop_reason = None
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                    if chunk.choices and chunk.choices[0].finish_reason:
+                        stop_reason = chunk.choices[0].finish_reason
+                truncated = stop_reason == "length"
             else:
                 # Anthropic Claude API call
-                response = self.client.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=1000,
-                    temperature=0.5,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": user_prompt}
-                    ]
+                async with self.client.messages.stream(**request) as stream:
+                    async for text in stream.text_stream:
+                        yield text
+                    truncated = (await stream.get_final_message()).stop_reason == "max_tokens"
+        if truncated:
+            raise IncompleteResponseError(f"Response stopped at max_tokens={max_tokens}")
+    
+    async def _chat_cypher(self, user: str, *, user_prefix: Optional[str] = None,
+                           model: Optional[str] = None) -> str:
+        """Ask for a query through the Cypher tools and return it as Cypher text"""
+        request = self._request(_CYPHER_SYSTEM_PROMPT, user, max_tokens=_CYPHER_MAX_TOKENS, temperature=0,
+                                user_prefix=user_prefix, model=model)
+        async with self._gate:
+            if self.use_openai:
+                response = await self.client.chat.completions.create(
+                    tools=_OPENAI_CYPHER_TOOLS, tool_choice="required", **request
+                )
+                call = response.choices[0].message.tool_calls[0].function
+                name, arguments = call.name, orjson.loads(call.arguments)
+            else:
+                response = await self.client.messages.create(
+                    tools=_CYPHER_TOOLS, tool_choice={"type": "any"}, **request
+                )
+                block = next(b for b in response.content if b.type == "tool_use")
+                name, arguments = block.name, block.input
+        return _tool_cypher(name, arguments)
+    
+    async def parse_visual_command(self, question: str) -> dict:
+        """Parse natural language into visual commands"""
+        
+        fast_result = _fast_visual_command(question)
+        if fast_result is not None:
+            logger.info("Parsed visual command locally: %s", fast_result)
+            return fast_result
+        
+        user_prompt = _visual_user_prompt(question)
+
+        try:
+            cache_key = LLMCache.make_key(self.model, _VISUAL_SYSTEM_PROMPT, user_prompt)
+            result = await self.cache.get(cache_key)
+            cache_hit = result is not None
+            if not cache_hit:
+                result = await self._chat(
+                    _VISUAL_SYSTEM_PROMPT, user_prompt,
+                    max_tokens=300, temperature=0, response_format=_JSON_RESPONSE_FORMAT
+                )
+            
+            # Parse and validate JSON response
+            parsed = _parse_visual_command_json(result)
+            if not cache_hit:
+                await self.cache.set(cache_key, result)
+            
+            logger.info("Parsed visual command: %s", parsed)
+            return parsed
+            
+        except Exception as e:
+            logger.error(f"Error parsing visual command: {e}")
+            return {
+                "has_command": False,
+                "message": "コマンドの解析に失敗しました"
+            }
+    
+    async def generate_cypher(self, question: str, session_id: str, model: Optional[str] = None,
+                              session_summary=None) -> str:
+        """Generate Cypher query from natural language question (on the smaller Cypher model by default).
+
+        ``session_summary`` is the session's IfcSession node, or an async
+        callable returning it that is only invoked when the LLM is actually
+        called; when given, it is sent as a per-session cached block after the
+        shared system prompt.
+        """
+        
+        cypher_query = _direct_cypher(question)
+        if cypher_query is not None:
+            logger.info("Answered from the count table: %s", cypher_query)
+            return cypher_query
+        
+        model = model or self.cypher_model
+        user_prompt = _cypher_user_prompt(question)
+
+        try:
+            cypher_query = await self.cache.get(LLMCache.make_key(model, _CYPHER_SYSTEM_PROMPT, user_prompt))
+            if cypher_query is None:
+                cypher_query = await self._structural_cypher(model, question)
+            if cypher_query is None:
+                if callable(session_summary):
+                    session_summary = await session_summary()
+                cypher_query = await self._chat_cypher(
+                    user_prompt, user_prefix=_session_summary_prompt(session_summary), model=model
                 )
-                natural_response = response.content[0].text.strip()
-            logger.info(f"Generated natural response: {natural_response}")
-            return natural_response
+                await self._remember_cypher(model, question, cypher_query)
+            
+            cypher_query = _clean_cypher(cypher_query)
+            
+            logger.info("Generated Cypher query: %s", cypher_query)
+            return cypher_query
             
+        except Exception as e:
+            logger.error(f"Error generating Cypher query: {e}")
+            # Smart fallback based on question content
+            return _fallback_cypher(question)
+    
+    async def _structural_cypher(self, model: str, question: str) -> Optional[str]:
+        """Build a query from a cached template of a structurally identical question"""
+        structure = _cypher_skeleton(question)
+        if structure is None:
+            return None
+        skeleton, noun = structure
+        template = await self.cache.get(LLMCache.make_key(model, _CYPHER_SYSTEM_PROMPT, _SKELETON_KEY_PREFIX + skeleton))
+        if template is None:
+            return None
+        logger.debug("Structural cache hit for %s", skeleton)
+        return _fill_cypher_template(template, noun)
+    
+    async def _remember_cypher(self, model: str, question: str, raw: str):
+        """Cache a generated query by exact prompt and, when reusable, by question skeleton"""
+        await self.cache.set(LLMCache.make_key(model, _CYPHER_SYSTEM_PROMPT, _cypher_user_prompt(question)), raw)
+        structure = _cypher_skeleton(question)
+        if structure is None:
+            return
+        skeleton, noun = structure
+        template = _cypher_template(_clean_cypher(raw), noun)
+        if template is not None:
+            await self.cache.set(LLMCache.make_key(model, _CYPHER_SYSTEM_PROMPT, _SKELETON_KEY_PREFIX + skeleton), template)
+    
+    async def generate_cypher_batch(self, questions: list, poll_interval: float = 30.0) -> list:
+        """Generate Cypher queries for many questions via the provider batch API.
+
+        Intended for non-interactive work (evaluation runs, cache warmup). Queries
+        are parameterized on $session_id, so no session is needed. Questions that
+        are answered directly or already cached are not submitted; results are
+        returned in input order and failed items fall back to the keyword table.
+        """
+        model = self.cypher_model
+        cypher_queries = [_direct_cypher(question) for question in questions]
+        for i, question in enumerate(questions):
+            if cypher_queries[i] is None:
+                cached = await self.cache.get(LLMCache.make_key(model, _CYPHER_SYSTEM_PROMPT, _cypher_user_prompt(question)))
+                if cached is not None:
+                    cypher_queries[i] = _clean_cypher(cached)
+        
+        pending = [i for i, cypher_query in enumerate(cypher_queries) if cypher_query is None]
+        if len(pending) <= 1:
+            for i in pending:
+                cypher_queries[i] = await self.generate_cypher(questions[i], "")
+            return cypher_queries
+
+        pending_questions = [questions[i] for i in pending]
+        if self.use_openai:
+            raw_results = await self._run_openai_batch(model, pending_questions, poll_interval)
+        else:
+            raw_results = await self._run_anthropic_batch(model, pending_questions, poll_interval)
+
+        for n, i in enumerate(pending):
+            question = questions[i]
+            raw = raw_results.get(str(n))
+            if raw is None:
+                logger.warning(f"Batch item {i} failed, using fallback query")
+                cypher_queries[i] = _fallback_cypher(question)
+                continue
+            await self._remember_cypher(model, question, raw)
+            cypher_queries[i] = _clean_cypher(raw)
+        return cypher_queries
+    
+    async def _run_anthropic_batch(self, model: str, questions: list, poll_interval: float) -> dict:
+        batch = await self.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": str(i),
+                    "params": {
+                        "model": model,
+                        "max_tokens": _CYPHER_MAX_TOKENS,
+                        "stop_sequences": _CYPHER_STOP_SEQUENCES,
+                        "temperature": 0,
+                        "system": _cacheable_system(_CYPHER_SYSTEM_PROMPT),
+                        "messages": [
+                            {"role": "user", "content": _cypher_user_prompt(question)}
+                        ]
+                    }
+                }
+                for i, question in enumerate(questions)
+            ]
+        )
+        logger.info(f"Submitted Anthropic batch {batch.id} with {len(questions)} requests")
+
+        while batch.processing_status != "ended":
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+
+        results = {}
+        async for entry in await self.client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = entry.result.message.content[0].text.strip()
+        return results
+    
+    async def _run_openai_batch(self, model: str, questions: list, poll_interval: float) -> dict:
+        lines = [
+            orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "max_tokens": _CYPHER_MAX_TOKENS,
+                    "stop": _CYPHER_STOP_SEQUENCES,
+                    "temperature": 0,
+                    "messages": [
+                        {"role": "system", "content": _CYPHER_SYSTEM_PROMPT},
+                        {"role": "user", "content": _cypher_user_prompt(question)}
+                    ]
+                }
+            })
+            for i, question in enumerate(questions)
+        ]
+        input_file = await self.client.files.create(
+            file=("cypher_batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted OpenAI batch {batch.id} with {len(questions)} requests")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+
+        results = {}
+        if not batch.output_file_id:
+            logger.error(f"OpenAI batch {batch.id} finished with status {batch.status}")
+            return results
+        output = await self.client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line:
+                continue
+            entry = orjson.loads(line)
+            response = entry.get("response") or {}
+            if response.get("status_code") == 200:
+                results[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+        return results
+    
+    async def classify_and_generate(self, question: str, session_id: str, session_summary=None) -> tuple:
+        """Parse a visual command and generate Cypher for the same question concurrently.
+
+        Returns (visual_command_result, cypher_query); either item is the raised
+        exception if that call failed. When the question is a visual command,
+        cypher_query is None: local matches make no model call, and otherwise
+        the Cypher generation is cancelled as soon as the command is parsed.
+        """
+        fast_result = _fast_visual_command(question)
+        if fast_result is not None:
+            logger.info("Parsed visual command locally: %s", fast_result)
+            return fast_result, None
+        
+        cypher_task = asyncio.create_task(
+            self.generate_cypher(question, session_id, session_summary=session_summary)
+        )
+        try:
+            try:
+                visual_command_result = await self.parse_visual_command(question)
+            except Exception as e:
+                visual_command_result = e
+            if isinstance(visual_command_result, dict) and visual_command_result.get("has_command"):
+                return visual_command_result, None
+            try:
+                cypher_query = await cypher_task
+            except Exception as e:
+                cypher_query = e
+            return visual_command_result, cypher_query
+        finally:
+            if not cypher_task.done():
+                cypher_task.cancel()
+    
+    def _conversation_context(self, session_id: Optional[str], conversation_history: Optional[list]) -> str:
+        """Format the latest history messages within the token budget, reusing the cached tail when the history only grew"""
+        if not conversation_history:
+            return ""
+        
+        current_len = len(conversation_history)
+        cached = self._history_cache.get(session_id) if session_id else None
+        if (cached and cached[0] <= current_len and cached[1]
+                and cached[1][-1] == _format_history_line(conversation_history[cached[0] - 1])):
+            lines = cached[1] + [_format_history_line(msg) for msg in conversation_history[cached[0]:]]
+        else:
+            lines = [_format_history_line(msg) for msg in conversation_history[-_HISTORY_WINDOW:]]
+        lines = lines[-_HISTORY_WINDOW:]
+        
+        if session_id:
+            self._history_cache[session_id] = (current_len, lines)
+            self._history_cache.move_to_end(session_id)
+            if len(self._history_cache) > _HISTORY_CACHE_SESSIONS:
+                self._history_cache.popitem(last=False)
+        
+        return "\n会話履歴:\n" + "".join(_budget_history(lines)) + "\n"
+    
+    async def stream_natural_response(self, question: str, query_result: list, conversation_history: list = None,
+                                      session_id: Optional[str] = None, model: Optional[str] = None) -> AsyncIterator[str]:
+        """Stream a natural language response from query results as text chunks"""
+        
+        # 会話履歴を構築
+        conversation_context = self._conversation_context(session_id, conversation_history)
+
+        user_prompt = _NL_USER_TEMPLATE.format(
+            question=question, conversation_context=conversation_context, query_result=query_result
+        )
+
+        yielded = False
+        try:
+            async for text in self._chat_stream(
+                _NATURAL_SYSTEM_PROMPT, user_prompt,
+                max_tokens=1000, temperature=0.5, user_prefix=_NATURAL_INSTRUCTIONS, model=model
+            ):
+                yielded = True
+                yield text
+            
+        except IncompleteResponseError as e:
+            logger.warning(f"Natural response truncated: {e}")
+            raise
         except Exception as e:
             logger.error(f"Error generating natural response: {e}")
-            return "申し訳ございませんが、その情報を取得できませんでした。"
\ No newline at end of file
+            # Once text has gone out the caller must learn the answer is cut short
+            if yielded:
+                raise
+            yield NATURAL_RESPONSE_ERROR
+    
+    async def generate_natural_response(self, question: str, query_result: list, conversation_history: list = None,
+                                        session_id: Optional[str] = None, model: Optional[str] = None) -> tuple:
+        """Generate a natural language response from query results.
+
+        Returns the response and whether the model completed it normally; only
+        complete responses are safe to cache.
+        """
+        chunks = []
+        complete = True
+        try:
+            async for text in self.stream_natural_response(question, query_result, conversation_history, session_id, model):
+                chunks.append(text)
+        except IncompleteResponseError:
+            # Still worth showing, but not worth keeping
+            complete = False
+        except Exception:
+            # The stream broke off part-way; a fragment is not an answer
+            return NATURAL_RESPONSE_ERROR, False
+        natural_response = "".join(chunks).strip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Generated natural response: %s", natural_response[:500])
+        return natural_response, complete and natural_response != NATURAL_RESPONSE_ERROR
@@ -1,354 +1,252 @@
 import ifcopenshell
 import ifcopenshell.util.element
 import ifcopenshell.geom
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List
 import logging
 import json
+import multiprocessing
+import os
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Lookup label added to every node that carries a guid, so relationship creation
+# can match any container/element through one (session_id, guid) index
+NODE_LABEL = "IfcNode"
 
-def parse_ifc_to_neo4j(file_path: str, session_id: str, neo4j_service):
-    """Parse IFC file and store data in Neo4j"""
+# Number of leading products tessellated for the viewer per upload
+GEOMETRY_MAX_ELEMENTS = int(os.getenv("GEOMETRY_MAX_ELEMENTS", "100"))
+# Tessellation threads per parse
+GEOMETRY_THREADS = int(os.getenv("GEOMETRY_THREADS", multiprocessing.cpu_count()))
+
+# Per-session summary node, written once at the end of a parse
+SESSION_LABEL = "IfcSession"
+
+FURNITURE_TYPES = ["IfcFurnishingElement"]
+
+# Types counted as building elements in the session capability flags
+BUILDING_ELEMENT_TYPES = ["IfcWall", "IfcColumn", "IfcBeam", "IfcSlab", "IfcBuildingElementProxy"]
+
+# Element types stored with the generic IfcElement label
+ELEMENT_TYPES = [
+    "IfcWall", "IfcSlab", "IfcRoof", "IfcColumn", "IfcBeam",
+    "IfcStair", "IfcRamp", "IfcRailing", "IfcCurtainWall",
+    "IfcPlate", "IfcMember", "IfcFooting", "IfcPile",
+    "IfcFlowSegment", "IfcFlowFitting", "IfcFlowTerminal",
+    "IfcFlowController", "IfcFlowMovingDevice", "IfcFlowStorageDevice",
+    "IfcFlowTreatmentDevice", "IfcEnergyConversionDevice",
+    "IfcTransportElement", "IfcVirtualElement", "IfcGeographicElement",
+    "IfcSystemFurnitureElement", "IfcBuildingElementPart"
+]
+
+# schema name (e.g. IFC2X3, IFC4) -> the furniture/element types it declares, filled on first use
+TYPES_BY_SCHEMA: Dict[str, Dict[str, List[str]]] = {}
+
+
+# Building summary as a single statement: one CALL {} subquery per section, each
+# aggregating to exactly one row (missing building -> null, counts -> 0).
+# Node types use element_type when available, otherwise the primary label; the
+# session's nodes are read per label so each arm is a session_id index seek.
+BUILDING_INFO_QUERY = """
+CALL {
+    MATCH (b:IfcBuilding) WHERE b.session_id = $session_id
+    RETURN collect({name: b.name, description: b.description, guid: b.guid})[0] AS building
+}
+CALL {
+    MATCH (s:IfcBuildingStorey) WHERE s.session_id = $session_id
+    RETURN {count: count(s), names: collect(s.name), elevations: collect(s.elevation)} AS floors
+}
+CALL {
+    MATCH (sp:IfcSpace) WHERE sp.session_id = $session_id
+    RETURN {count: count(sp), names: collect(sp.name)} AS spaces
+}
+CALL {
+    MATCH (w:IfcWindow) WHERE w.session_id = $session_id
+    RETURN {count: count(w)} AS windows
+}
+CALL {
+    MATCH (d:IfcDoor) WHERE d.session_id = $session_id
+    RETURN {count: count(d)} AS doors
+}
+CALL {
+    MATCH (e:IfcBuildingElementProxy) WHERE e.session_id = $session_id
+    RETURN {count: count(e)} AS structural_elements
+}
+CALL {
+    CALL {
+        MATCH (n:IfcNode) WHERE n.session_id = $session_id RETURN n
+        UNION ALL
+        MATCH (n:IfcMaterial) WHERE n.session_id = $session_id RETURN n
+    }
+    WITH CASE
+             WHEN n.element_type IS NOT NULL THEN n.element_type
+             ELSE [label IN labels(n) WHERE label <> 'IfcNode'][0]
+         END as element_type, count(n) as count
+    ORDER BY count DESC
+    RETURN collect({labels: [element_type], count: count}) AS all_elements
+}
+CALL {
+    MATCH (m:IfcMaterial) WHERE m.session_id = $session_id
+    RETURN {count: count(m), names: collect(m.name)} AS materials
+}
+RETURN building, floors, spaces, windows, doors, structural_elements, all_elements, materials
+"""
+
+
+def parse_ifc_to_neo4j(file_path: str, session_id: str, neo4j_service, geometry_path: str) -> int:
+    """Parse IFC file, store data in Neo4j and write the viewer's meshes to geometry_path.
+
+    Returns the number of meshes written.
+    """
     ifc_file = ifcopenshell.open(file_path)
     
-    # Clear existing data for this session
-    neo4j_service.execute_query(
-        "MATCH (n {session_id: $session_id}) DETACH DELETE n",
-        {"session_id": session_id}
-    )
-    
-    geometry_data = []
-    
-    # Set up geometry processing
-    settings = ifcopenshell.geom.settings()
-    settings.set(settings.USE_WORLD_COORDS, True)
-    
-    # Get all products (geometric elements)
+    # Single pass over all products: read guid/name/description once (each attribute
+    # access crosses into ifcopenshell's C++ layer) and collect spatial containment /
+    # aggregation relationships at the same time
     products = ifc_file.by_type("IfcProduct")
+    furnishing_ids = {element.id() for element in ifc_file.by_type("IfcFurnishingElement")}
+    elem_meta = {}
+    contains_rels = []
+    decomposes_rels = []
+    furniture_count = 0
+    for product in products:
+        meta = extract_element_data(product)
+        elem_meta[product.id()] = meta
+        is_furniture = product.id() in furnishing_ids
+        # Special logging for furniture elements
+        if is_furniture:
+            furniture_count += 1
+            logger.info(f"Processing furniture element: {meta['name']} ({meta['guid']})")
+            
+        # Check for spatial containment
+        if hasattr(product, 'ContainedInStructure') and product.ContainedInStructure:
+            for rel in product.ContainedInStructure:
+                relating_structure = rel.RelatingStructure
+                if relating_structure:
+                    # Log furniture containment specifically
+                    if is_furniture:
+                        logger.info(f"  Furniture {meta['name']} contained in {relating_structure.is_a()}: {relating_structure.Name}")
+                    
+                    contains_rels.append({"from_guid": relating_structure.GlobalId, "to_guid": meta["guid"]})
+        
+        # Check for aggregation relationships
+        if hasattr(product, 'Decomposes') and product.Decomposes:
+            for rel in product.Decomposes:
+                if hasattr(rel, 'RelatingObject') and rel.RelatingObject:
+                    decomposes_rels.append({"from_guid": rel.RelatingObject.GlobalId, "to_guid": meta["guid"]})
     
     # Process geometry for visualization
     logger.info(f"Found {len(products)} products to process")
-    processed_count = 0
+    geometry_count = write_geometry(ifc_file, products[:GEOMETRY_MAX_ELEMENTS], geometry_path)
     
-    for product in products[:100]:  # Limit for performance
-        try:
-            if product.Representation:
-                logger.info(f"Processing {product.is_a()}: {product.GlobalId}")
-                shape = ifcopenshell.geom.create_shape(settings, product)
-                if shape:
-                    # Extract vertices and faces
-                    verts = shape.geometry.verts
-                    faces = shape.geometry.faces
-                    
-                    logger.info(f"  - Vertices: {len(verts)}, Faces: {len(faces)}")
-                    
-                    # Convert to format suitable for Three.js
-                    vertices = []
-                    for i in range(0, len(verts), 3):
-                        vertices.extend([verts[i], verts[i+1], verts[i+2]])
-                    
-                    indices = []
-                    for i in range(0, len(faces), 3):
-                        indices.extend([faces[i], faces[i+1], faces[i+2]])
-                    
-                    if len(vertices) > 0 and len(indices) > 0:
-                        geometry_info = {
-                            "type": product.is_a(),
-                            "guid": product.GlobalId,
-                            "name": product.Name or "",
-                            "vertices": vertices,
-                            "indices": indices
-                        }
-                        geometry_data.append(geometry_info)
-                        processed_count += 1
-                        logger.info(f"  - Added geometry data for {product.is_a()}")
-                    else:
-                        logger.warning(f"  - No valid geometry data for {product.is_a()}")
-                else:
-                    logger.warning(f"  - Could not create shape for {product.is_a()}")
-            else:
-                logger.info(f"Skipping {product.is_a()} - no representation")
-        except Exception as e:
-            logger.warning(f"Could not process geometry for {product.is_a()}: {e}")
+    logger.info(f"Successfully processed geometry for {geometry_count} elements")
     
-    logger.info(f"Successfully processed geometry for {processed_count} elements")
+    use_apoc = neo4j_service.has_procedure("apoc.create.node")
     
-    # Parse building
-    buildings = ifc_file.by_type("IfcBuilding")
-    for building in buildings:
-        building_data = extract_element_data(building)
-        building_data["session_id"] = session_id
-        # Replace placeholder building name
-        if building_data["name"] == "// BUILDING/NAME //":
-            building_data["name"] = "Large Building"
-        # Add description if empty
-        if not building_data["description"] or building_data["description"] == "":
-            building_data["description"] = "2階建て多目的施設 - BIMデモ用サンプル建築物"
-        neo4j_service.execute_query(
-            """
-            CREATE (b:IfcBuilding {
-                guid: $guid,
-                name: $name,
-                session_id: $session_id,
-                description: $description
-            })
-            """,
-            building_data
+    # Nodes are written in one transaction (one commit instead of one per query);
+    # relationships follow in a second one to bound the transaction size
+    with neo4j_service.transaction() as tx:
+        # Clear existing data for this session
+        tx.execute_query(
+            "MATCH (n {session_id: $session_id}) DETACH DELETE n",
+            {"session_id": session_id}
         )
-    
-    # Parse building storeys
-    storeys = ifc_file.by_type("IfcBuildingStorey")
-    for storey in storeys:
-        storey_data = extract_element_data(storey)
-        storey_data["session_id"] = session_id
-        storey_data["elevation"] = float(storey.Elevation) if hasattr(storey, 'Elevation') and storey.Elevation else 0.0
         
-        neo4j_service.execute_query(
-            """
-            CREATE (s:IfcBuildingStorey {
-                guid: $guid,
-                name: $name,
-                session_id: $session_id,
-                elevation: $elevation,
-                description: $description
-            })
-            """,
-            storey_data
-        )
+        # Parse building
+        buildings = ifc_file.by_type("IfcBuilding")
+        building_rows = []
+        for building in buildings:
+            building_data = dict(elem_meta[building.id()])
+            building_data["session_id"] = session_id
+            # Replace placeholder building name
+            if building_data["name"] == "// BUILDING/NAME //":
+                building_data["name"] = "Large Building"
+            # Add description if empty
+            if not building_data["description"] or building_data["description"] == "":
+                building_data["description"] = "2階建て多目的施設 - BIMデモ用サンプル建築物"
+            building_rows.append(building_data)
+        create_nodes(tx, f"{NODE_LABEL}:IfcBuilding", building_rows)
         
-        # Create relationship to building
-        if hasattr(storey, 'Decomposes') and storey.Decomposes:
-            for rel in storey.Decomposes:
-                if rel.RelatingObject.is_a("IfcBuilding"):
-                    neo4j_service.execute_query(
-                        """
-                        MATCH (b:IfcBuilding {guid: $building_guid, session_id: $session_id})
-                        MATCH (s:IfcBuildingStorey {guid: $storey_guid, session_id: $session_id})
-                        CREATE (b)-[:CONTAINS_STOREY]->(s)
-                        """,
-                        {
-                            "building_guid": rel.RelatingObject.GlobalId,
-                            "storey_guid": storey.GlobalId,
-                            "session_id": session_id
-                        }
-                    )
-    
-    # Parse spaces
-    spaces = ifc_file.by_type("IfcSpace")
-    for space in spaces:
-        space_data = extract_element_data(space)
-        space_data["session_id"] = session_id
+        # Parse building storeys
+        storeys = ifc_file.by_type("IfcBuildingStorey")
+        storey_rows = []
+        storey_rels = []
+        for storey in storeys:
+            storey_data = dict(elem_meta[storey.id()])
+            storey_data["session_id"] = session_id
+            storey_data["elevation"] = float(storey.Elevation) if hasattr(storey, 'Elevation') and storey.Elevation else 0.0
+            storey_rows.append(storey_data)
         
-        neo4j_service.execute_query(
-            """
-            CREATE (sp:IfcSpace {
-                guid: $guid,
-                name: $name,
-                session_id: $session_id,
-                description: $description
-            })
-            """,
-            space_data
-        )
+            # Relationship to building
+            if hasattr(storey, 'Decomposes') and storey.Decomposes:
+                for rel in storey.Decomposes:
+                    if rel.RelatingObject.is_a("IfcBuilding"):
+                        storey_rels.append({"from_guid": rel.RelatingObject.GlobalId, "to_guid": elem_meta[storey.id()]["guid"]})
+        create_nodes(tx, f"{NODE_LABEL}:IfcBuildingStorey", storey_rows)
+        create_relationships(tx, "CONTAINS_STOREY", storey_rels, session_id, "IfcBuilding", "IfcBuildingStorey")
         
-        # Create relationship to storey
-        if hasattr(space, 'Decomposes') and space.Decomposes:
-            for rel in space.Decomposes:
-                if rel.RelatingObject.is_a("IfcBuildingStorey"):
-                    neo4j_service.execute_query(
-                        """
-                        MATCH (s:IfcBuildingStorey {guid: $storey_guid, session_id: $session_id})
-                        MATCH (sp:IfcSpace {guid: $space_guid, session_id: $session_id})
-                        CREATE (s)-[:CONTAINS_SPACE]->(sp)
-                        """,
-                        {
-                            "storey_guid": rel.RelatingObject.GlobalId,
-                            "space_guid": space.GlobalId,
-                            "session_id": session_id
-                        }
-                    )
-    
-    # Parse doors
-    doors = ifc_file.by_type("IfcDoor")
-    for door in doors:
-        door_data = extract_element_data(door)
-        door_data["session_id"] = session_id
+        # Parse spaces
+        spaces = ifc_file.by_type("IfcSpace")
+        space_rows = []
+        space_rels = []
+        for space in spaces:
+            space_data = dict(elem_meta[space.id()])
+            space_data["session_id"] = session_id
+            space_rows.append(space_data)
         
-        neo4j_service.execute_query(
-            """
-            CREATE (d:IfcDoor {
-                guid: $guid,
-                name: $name,
-                session_id: $session_id,
-                description: $description
-            })
-            """,
-            door_data
-        )
-    
-    # Parse windows
-    windows = ifc_file.by_type("IfcWindow")
-    for window in windows:
-        window_data = extract_element_data(window)
-        window_data["session_id"] = session_id
+            # Relationship to storey
+            if hasattr(space, 'Decomposes') and space.Decomposes:
+                for rel in space.Decomposes:
+                    if rel.RelatingObject.is_a("IfcBuildingStorey"):
+                        space_rels.append({"from_guid": rel.RelatingObject.GlobalId, "to_guid": elem_meta[space.id()]["guid"]})
+        create_nodes(tx, f"{NODE_LABEL}:IfcSpace", space_rows)
+        create_relationships(tx, "CONTAINS_SPACE", space_rels, session_id, "IfcBuildingStorey", "IfcSpace")
         
-        neo4j_service.execute_query(
-            """
-            CREATE (w:IfcWindow {
-                guid: $guid,
-                name: $name,
-                session_id: $session_id,
-                description: $description
-            })
-            """,
-            window_data
-        )
-    
-    # Parse building element proxies (walls, columns, etc.)
-    element_proxies = ifc_file.by_type("IfcBuildingElementProxy")
-    for element in element_proxies:
-        element_data = extract_element_data(element)
-        element_data["session_id"] = session_id
+        # Parse doors, windows and building element proxies (walls, columns, etc.)
+        for label in ("IfcDoor", "IfcWindow", "IfcBuildingElementProxy"):
+            rows = []
+            for element in ifc_file.by_type(label):
+                element_data = dict(elem_meta[element.id()])
+                element_data["session_id"] = session_id
+                rows.append(element_data)
+            create_nodes(tx, f"{NODE_LABEL}:{label}", rows)
         
-        neo4j_service.execute_query(
-            """
-            CREATE (e:IfcBuildingElementProxy {
-                guid: $guid,
-                name: $name,
-                session_id: $session_id,
-                description: $description
-            })
-            """,
-            element_data
-        )
-    
-    # Parse furniture and furnishing elements
-    # Note: IfcFurniture only exists in IFC4, not in IFC2X3
-    # For IFC2X3, we'll look for IfcFurnishingElement instead
-    furniture_types = ["IfcFurnishingElement"]
-    
-    # Try to parse IfcFurniture if it exists (IFC4)
-    try:
-        if hasattr(ifc_file.schema, 'declaration_by_name') and ifc_file.schema.declaration_by_name('IfcFurniture'):
-            furniture_types.append("IfcFurniture")
-    except:
-        logger.info("IfcFurniture not available in this IFC schema version")
-    
-    for furniture_type in furniture_types:
-        try:
+        # Parse furniture and furnishing elements
+        # by_type includes subtypes, so IFC4 IfcFurniture is already covered by IfcFurnishingElement
+        schema_types = types_for_schema(ifc_file.schema)
+        for furniture_type in schema_types["furniture"]:
             furniture_elements = ifc_file.by_type(furniture_type)
             if furniture_elements:
                 logger.info(f"Found {len(furniture_elements)} {furniture_type} elements")
+                rows = []
                 for furniture in furniture_elements:
-                    furniture_data = extract_element_data(furniture)
+                    furniture_data = dict(elem_meta[furniture.id()])
                     furniture_data["session_id"] = session_id
                     furniture_data["element_type"] = furniture_type
-                    
-                    neo4j_service.execute_query(
-                        f"""
-                        CREATE (f:IfcFurnishingElement {{
-                            guid: $guid,
-                            name: $name,
-                            session_id: $session_id,
-                            description: $description,
-                            element_type: $element_type
-                        }})
-                        """,
-                        furniture_data
-                    )
-        except Exception as e:
-            logger.warning(f"Could not parse {furniture_type}: {e}")
-    
-    # Parse all other IFC elements to ensure nothing is missed
-    all_element_types = [
-        "IfcWall", "IfcSlab", "IfcRoof", "IfcColumn", "IfcBeam",
-        "IfcStair", "IfcRamp", "IfcRailing", "IfcCurtainWall",
-        "IfcPlate", "IfcMember", "IfcFooting", "IfcPile",
-        "IfcFlowSegment", "IfcFlowFitting", "IfcFlowTerminal",
-        "IfcFlowController", "IfcFlowMovingDevice", "IfcFlowStorageDevice",
-        "IfcFlowTreatmentDevice", "IfcEnergyConversionDevice",
-        "IfcTransportElement", "IfcVirtualElement", "IfcGeographicElement",
-        "IfcSystemFurnitureElement", "IfcBuildingElementPart"
-    ]
-    
-    for element_type in all_element_types:
-        try:
+                    rows.append(furniture_data)
+                create_nodes(tx, f"{NODE_LABEL}:IfcFurnishingElement", rows)
+        
+        # Parse all other IFC elements to ensure nothing is missed
+        typed_rows = []
+        for element_type in schema_types["elements"]:
             elements = ifc_file.by_type(element_type)
             if elements:
                 logger.info(f"Found {len(elements)} {element_type} elements")
                 for element in elements:
-                    element_data = extract_element_data(element)
+                    element_data = dict(elem_meta[element.id()])
                     element_data["session_id"] = session_id
                     element_data["element_type"] = element_type
-                    
-                    # Create node with both generic IfcElement label and specific type label
-                    neo4j_service.execute_query(
-                        f"""
-                        CREATE (n:IfcElement:{element_type} {{
-                            guid: $guid,
-                            name: $name,
-                            session_id: $session_id,
-                            description: $description,
-                            element_type: $element_type
-                        }})
-                        """,
-                        element_data
-                    )
-        except Exception as e:
-            # Some element types may not exist in all IFC versions
-            logger.debug(f"Element type {element_type} not found in this IFC file: {e}")
+                    typed_rows.append(element_data)
+        
+        # Create nodes with both generic IfcElement label and specific type label
+        create_typed_nodes(tx, typed_rows, use_apoc)
     
     # Parse and create relationships for all elements
     logger.info("Creating relationships between elements...")
     
-    # Get all elements and create spatial containment relationships
-    all_products = ifc_file.by_type("IfcProduct")
-    furniture_count = 0
-    for product in all_products:
-        # Special logging for furniture elements
-        if product.is_a("IfcFurnishingElement"):
-            furniture_count += 1
-            logger.info(f"Processing furniture element: {product.Name} ({product.GlobalId})")
-            
-        # Check for spatial containment
-        if hasattr(product, 'ContainedInStructure') and product.ContainedInStructure:
-            for rel in product.ContainedInStructure:
-                relating_structure = rel.RelatingStructure
-                if relating_structure:
-                    # Log furniture containment specifically
-                    if product.is_a("IfcFurnishingElement"):
-                        logger.info(f"  Furniture {product.Name} contained in {relating_structure.is_a()}: {relating_structure.Name}")
-                    
-                    neo4j_service.execute_query(
-                        """
-                        MATCH (container {guid: $container_guid, session_id: $session_id})
-                        MATCH (element {guid: $element_guid, session_id: $session_id})
-                        CREATE (container)-[:CONTAINS]->(element)
-                        """,
-                        {
-                            "container_guid": relating_structure.GlobalId,
-                            "element_guid": product.GlobalId,
-                            "session_id": session_id
-                        }
-                    )
-        
-        # Check for aggregation relationships
-        if hasattr(product, 'Decomposes') and product.Decomposes:
-            for rel in product.Decomposes:
-                if hasattr(rel, 'RelatingObject') and rel.RelatingObject:
-                    neo4j_service.execute_query(
-                        """
-                        MATCH (parent {guid: $parent_guid, session_id: $session_id})
-                        MATCH (child {guid: $child_guid, session_id: $session_id})
-                        CREATE (parent)-[:DECOMPOSES]->(child)
-                        """,
-                        {
-                            "parent_guid": rel.RelatingObject.GlobalId,
-                            "child_guid": product.GlobalId,
-                            "session_id": session_id
-                        }
-                    )
+    with neo4j_service.transaction() as tx:
+        create_relationships(tx, "CONTAINS", contains_rels, session_id, NODE_LABEL, NODE_LABEL)
+        create_relationships(tx, "DECOMPOSES", decomposes_rels, session_id, NODE_LABEL, NODE_LABEL)
     
     logger.info(f"Total furniture elements processed: {furniture_count}")
     
@@ -362,9 +260,89 @@ def parse_ifc_to_neo4j(file_path: str, session_id: str, neo4j_service):
         import traceback
         traceback.print_exc()
     
+    write_session_summary(neo4j_service, session_id)
+    
     logger.info(f"Successfully parsed IFC file for session {session_id}")
     
-    return geometry_data
+    return geometry_count
+
+
+def write_geometry(ifc_file, products: List[Any], path: str) -> int:
+    """Write the meshes of ``products`` to ``path`` as a JSON array, in the order given.
+
+    Meshes arrive in completion order, so each is serialized to a spool file as
+    soon as it is tessellated and the array is then assembled from the spool;
+    at most one mesh is held in memory. Returns the number of meshes written.
+    """
+    spool_path = f"{path}.spool"
+    spans = {}
+    try:
+        with open(spool_path, "w+b") as spool:
+            for mesh in iter_geometry(ifc_file, products):
+                data = orjson.dumps(mesh)
+                spans[mesh["guid"]] = (spool.tell(), len(data))
+                spool.write(data)
+            
+            with open(path, "wb") as out:
+                out.write(b"[")
+                written = 0
+                for product in products:
+                    span = spans.get(product.GlobalId)
+                    if span is None:
+                        continue
+                    spool.seek(span[0])
+                    if written:
+                        out.write(b",")
+                    out.write(spool.read(span[1]))
+                    written += 1
+                out.write(b"]")
+    finally:
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+    return written
+
+
+def iter_geometry(ifc_file, products: List[Any], threads: int = GEOMETRY_THREADS) -> Iterator[Dict[str, Any]]:
+    """Yield the meshes of ``products`` as they are tessellated.
+
+    Only those products are tessellated, on worker threads, so meshes arrive in
+    completion order; write_geometry restores the product order.
+    """
+    if not products:
+        return
+    settings = ifcopenshell.geom.settings()
+    settings.set(settings.USE_WORLD_COORDS, True)
+    
+    iterator = ifcopenshell.geom.iterator(settings, ifc_file, threads, include=products)
+    try:
+        has_shapes = iterator.initialize()
+    except Exception as e:
+        logger.warning(f"Could not initialize geometry iterator: {e}")
+        has_shapes = False
+    
+    while has_shapes:
+        shape = iterator.get()
+        try:
+            logger.info(f"Processing {shape.type}: {shape.guid}")
+            # verts/faces are already flat xyz / triangle-index tuples, as Three.js expects
+            verts = shape.geometry.verts
+            faces = shape.geometry.faces
+            
+            logger.info(f"  - Vertices: {len(verts)}, Faces: {len(faces)}")
+            
+            if len(verts) > 0 and len(faces) > 0:
+                yield {
+                    "type": shape.type,
+                    "guid": shape.guid,
+                    "name": shape.name or "",
+                    "vertices": verts,
+                    "indices": faces
+                }
+            else:
+                logger.warning(f"  - No valid geometry data for {shape.type}")
+        except Exception as e:
+            logger.warning(f"Could not process geometry for {shape.type}: {e}")
+        has_shapes = iterator.next()
 
 
 def parse_materials(ifc_file, session_id: str, neo4j_service):
@@ -376,29 +354,19 @@ def parse_materials(ifc_file, session_id: str, neo4j_service):
         materials = ifc_file.by_type("IfcMaterial")
         logger.info(f"Found {len(materials)} IfcMaterial entities in the IFC file")
         
-        created_materials = []
+        material_rows = []
         for material in materials:
             material_name = material.Name or ""
             if material_name:  # Only process materials with names
-                material_data = {
+                material_rows.append({
                     "name": material_name,
                     "description": material.Description or "" if hasattr(material, 'Description') else "",
                     "session_id": session_id
-                }
-                
-                # Create material node
-                neo4j_service.execute_query(
-                    """
-                    CREATE (m:IfcMaterial {
-                        name: $name,
-                        description: $description,
-                        session_id: $session_id
-                    })
-                    """,
-                    material_data
-                )
-                created_materials.append(material_name)
-                logger.info(f"Created material node: {material_name}")
+                })
+        
+        # Create material nodes
+        create_nodes(neo4j_service, "IfcMaterial", material_rows)
+        created_materials = [row["name"] for row in material_rows]
         
         logger.info(f"Successfully created {len(created_materials)} material nodes")
         logger.info(f"Created materials: {created_materials[:10]}{'...' if len(created_materials) > 10 else ''}")
@@ -411,6 +379,105 @@ def parse_materials(ifc_file, session_id: str, neo4j_service):
         traceback.print_exc()
 
 
+def write_session_summary(neo4j_service, session_id: str) -> Dict[str, Any]:
+    """Aggregate the parsed session once and store it on its IfcSession node.
+
+    The node carries the building-info summary as JSON plus flat counts and
+    capability flags, so readers don't have to rescan the session's elements.
+    """
+    info = dict(neo4j_service.execute_query(BUILDING_INFO_QUERY, {"session_id": session_id})[0])
+    element_types = {elem["labels"][0] for elem in info["all_elements"]}
+    summary = {
+        "building_info": json.dumps(info, ensure_ascii=False),
+        "floor_count": info["floors"]["count"],
+        "space_count": info["spaces"]["count"],
+        "window_count": info["windows"]["count"],
+        "door_count": info["doors"]["count"],
+        "material_count": info["materials"]["count"],
+        "element_count": sum(elem["count"] for elem in info["all_elements"]),
+        "has_floors": info["floors"]["count"] > 0,
+        "has_spaces": info["spaces"]["count"] > 0,
+        "has_windows": info["windows"]["count"] > 0,
+        "has_doors": info["doors"]["count"] > 0,
+        "has_furniture": not element_types.isdisjoint(FURNITURE_TYPES),
+        "has_building_elements": not element_types.isdisjoint(BUILDING_ELEMENT_TYPES),
+    }
+    neo4j_service.execute_query(
+        f"MERGE (m:{SESSION_LABEL} {{session_id: $session_id}}) SET m += $summary",
+        {"session_id": session_id, "summary": summary}
+    )
+    return summary
+
+
+def types_for_schema(schema_name: str) -> Dict[str, List[str]]:
+    """Furniture and element types that exist in the given IFC schema"""
+    if schema_name not in TYPES_BY_SCHEMA:
+        schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema_name)
+        declared = {declaration.name() for declaration in schema.declarations()}
+        TYPES_BY_SCHEMA[schema_name] = {
+            "furniture": [t for t in FURNITURE_TYPES if t in declared],
+            "elements": [t for t in ELEMENT_TYPES if t in declared],
+        }
+    return TYPES_BY_SCHEMA[schema_name]
+
+
+def create_nodes(neo4j_service, labels: str, rows: List[Dict[str, Any]]):
+    """Create one node per row in a single UNWIND query"""
+    if not rows:
+        return
+    properties = ", ".join(f"{key}: r.{key}" for key in rows[0])
+    neo4j_service.execute_query(
+        f"""
+        UNWIND $rows AS r
+        CREATE (n:{labels} {{{properties}}})
+        """,
+        {"rows": rows}
+    )
+
+
+def create_typed_nodes(neo4j_service, rows: List[Dict[str, Any]], use_apoc: bool = True):
+    """Create IfcElement nodes labelled with their own element_type.
+
+    With APOC this is a single apoc.create.node query; otherwise one UNWIND per
+    element type.
+    """
+    if not rows:
+        return
+    if use_apoc:
+        neo4j_service.execute_query(
+            f"""
+            UNWIND $rows AS r
+            CALL apoc.create.node(['{NODE_LABEL}', 'IfcElement', r.element_type], r) YIELD node
+            RETURN count(node) AS created
+            """,
+            {"rows": rows}
+        )
+        return
+    rows_by_type: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        rows_by_type.setdefault(row["element_type"], []).append(row)
+    for element_type, type_rows in rows_by_type.items():
+        create_nodes(neo4j_service, f"{NODE_LABEL}:IfcElement:{element_type}", type_rows)
+
+
+def create_relationships(neo4j_service, rel_type: str, rels: List[Dict[str, str]], session_id: str,
+                         from_label: str = "", to_label: str = ""):
+    """Create relationships between existing nodes, matched by guid, in a single UNWIND query"""
+    if not rels:
+        return
+    from_label = f":{from_label}" if from_label else ""
+    to_label = f":{to_label}" if to_label else ""
+    neo4j_service.execute_query(
+        f"""
+        UNWIND $rels AS r
+        MATCH (a{from_label} {{guid: r.from_guid, session_id: $session_id}})
+        MATCH (b{to_label} {{guid: r.to_guid, session_id: $session_id}})
+        CREATE (a)-[:{rel_type}]->(b)
+        """,
+        {"rels": rels, "session_id": session_id}
+    )
+
+
 def extract_element_data(element) -> Dict[str, Any]:
     """Extract basic data from IFC element"""
     return {
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """Response cache for deterministic (temperature=0) LLM calls.
+
+    Keeps an in-process LRU and, when a Redis URL is given, mirrors entries
+    to Redis so they are shared across workers and survive restarts.
+    """
+
+    def __init__(self, maxsize: int = 1024, redis_url: Optional[str] = None):
+        self.maxsize = maxsize
+        self._local: "OrderedDict[str, str]" = OrderedDict()
+        self._redis = None
+        if redis_url:
+            if aioredis is None:
+                logger.warning("REDIS_URL is set but redis is not installed; using in-process cache only")
+            else:
+                self._redis = aioredis.from_url(redis_url, decode_responses=True)
+
+    @staticmethod
+    def make_key(model: str, system: str, user: str, temperature: float = 0) -> str:
+        payload = json.dumps(
+            {"model": model, "system": system, "user": user, "temp": temperature},
+            sort_keys=True,
+        )
+        return "llm:" + hashlib.sha256(payload.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        if key in self._local:
+            self._local.move_to_end(key)
+            return self._local[key]
+        if self._redis is not None:
+            try:
+                value = await self._redis.get(key)
+            except Exception as e:
+                logger.warning(f"Redis cache get failed: {e}")
+                return None
+            if value is not None:
+                self._remember(key, value)
+                return value
+        return None
+
+    async def set(self, key: str, value: str, ttl: int = 86400):
+        self._remember(key, value)
+        if self._redis is not None:
+            try:
+                await self._redis.set(key, value, ex=ttl)
+            except Exception as e:
+                logger.warning(f"Redis cache set failed: {e}")
+
+    def _remember(self, key: str, value: str):
+        self._local[key] = value
+        self._local.move_to_end(key)
+        if len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
@@ -1,19 +1,42 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+import asyncio
 import os
+from functools import partial
+import hashlib
+import json
 import uuid
 from pathlib import Path
 import aiofiles
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
-from ifc_parser import parse_ifc_to_neo4j
+from ifc_parser import BUILDING_INFO_QUERY, SESSION_LABEL, parse_ifc_to_neo4j
 from neo4j_service import Neo4jService
-from claude_service import ClaudeService
+from claude_service import NATURAL_RESPONSE_ERROR, ClaudeService, IncompleteResponseError, close_http_client
+from llm_cache import LLMCache
+from parsed_uploads import find_parsed_upload, geometry_path, iter_geometry_response, record_parsed_upload
 
 load_dotenv()
 
-app = FastAPI(title="BIM × AI Demo API")
+app = FastAPI(title="BIM × AI Demo API", default_response_class=ORJSONResponse)
+
+
+class GZipExceptChatStream(GZipMiddleware):
+    """GZip responses except /chat/stream, whose chunks must reach the client as they are generated"""
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/chat/stream":
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(GZipExceptChatStream, minimum_size=1024)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,23 +48,65 @@ app.add_middleware(
 
 UPLOAD_DIR = Path("/data/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# Uploads are copied to disk in chunks of this size rather than read whole
+UPLOAD_CHUNK_SIZE = 1 << 20
 
 neo4j_service = Neo4jService()
 claude_service = ClaudeService()
 
+# session_id -> building-info response. A parsed session never changes, so entries
+# only need dropping when a session is (re)parsed.
+BUILDING_INFO_CACHE = TTLCache(maxsize=256, ttl=3600)
+# session_id -> IfcSession properties, sent to the Cypher model as session context
+SESSION_SUMMARY_CACHE = TTLCache(maxsize=256, ttl=3600)
+# Final /chat answers for repeated questions, shared through Redis when REDIS_URL is set
+ANSWER_CACHE = LLMCache(redis_url=os.getenv("REDIS_URL"))
+ANSWER_CACHE_TTL = 86400
+CACHE_STATS = {
+    "building_info": {"hits": 0, "misses": 0},
+    "answers": {"hits": 0, "misses": 0},
+}
+# Ends a /chat/stream body whose answer failed after streaming had started
+STREAM_ERROR_MARKER = "\n[error] " + NATURAL_RESPONSE_ERROR
+
+
+def invalidate_session_cache(session_id: str):
+    BUILDING_INFO_CACHE.pop(session_id, None)
+    SESSION_SUMMARY_CACHE.pop(session_id, None)
+
+
+def answer_cache_key(session_id: str, question: str) -> str:
+    normalized = " ".join(question.lower().split())
+    return "answer:" + hashlib.sha256(f"{session_id}\n{normalized}".encode()).hexdigest()
+
+
+async def load_session_summary(session_id: str):
+    """Return the parse-time summary of a session, or None if it has none"""
+    if session_id in SESSION_SUMMARY_CACHE:
+        return SESSION_SUMMARY_CACHE[session_id]
+    rows = await neo4j_service.execute_query_async(
+        f"MATCH (m:{SESSION_LABEL} {{session_id: $session_id}}) RETURN properties(m) as summary",
+        {"session_id": session_id}
+    )
+    if not rows:
+        return None
+    SESSION_SUMMARY_CACHE[session_id] = rows[0]["summary"]
+    return rows[0]["summary"]
+
 
-async def analyze_ifc_capabilities_with_ai(building_info: dict, claude_service) -> dict:
-    """Generate comprehensive analysis capabilities based on available IFC data"""
+async def analyze_ifc_capabilities_with_ai(session: dict, claude_service) -> dict:
+    """Generate comprehensive analysis capabilities based on available IFC data
+
+    ``session`` is the IfcSession summary written at parse time.
+    """
     
     # Check what data is available
-    has_furniture = any(elem.get('labels', [''])[0] in ['IfcFurnishingElement', 'IfcFurniture'] 
-                       for elem in building_info.get('all_elements', []))
-    has_spaces = building_info.get('spaces', {}).get('count', 0) > 0
-    has_floors = building_info.get('floors', {}).get('count', 0) > 0
-    has_windows = building_info.get('windows', {}).get('count', 0) > 0
-    has_doors = building_info.get('doors', {}).get('count', 0) > 0
-    has_building_elements = any(elem.get('labels', [''])[0] in ['IfcWall', 'IfcColumn', 'IfcBeam', 'IfcSlab', 'IfcBuildingElementProxy'] 
-                               for elem in building_info.get('all_elements', []))
+    has_furniture = session.get('has_furniture', False)
+    has_spaces = session.get('has_spaces', False)
+    has_floors = session.get('has_floors', False)
+    has_windows = session.get('has_windows', False)
+    has_doors = session.get('has_doors', False)
+    has_building_elements = session.get('has_building_elements', False)
     
     # Enhanced capabilities list based on implemented features
     available_questions = [
@@ -87,7 +152,7 @@ async def analyze_ifc_capabilities_with_ai(building_info: dict, claude_service)
     if not has_furniture:
         limitations.append("家具情報が不足しているため、詳細なレイアウト分析に制限があります")
     
-    if building_info.get('floors', {}).get('count', 0) <= 1:
+    if session.get('floor_count', 0) <= 1:
         limitations.append("単層建物のため、階層別分析は限定的です")
     
     if not has_building_elements:
@@ -132,11 +197,13 @@ class ProviderStatus(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     neo4j_service.verify_connection()
+    neo4j_service.create_constraints()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    neo4j_service.close()
+    await neo4j_service.aclose()
+    await close_http_client()
 
 
 @app.post("/upload_ifc")
@@ -154,20 +221,41 @@ async def upload_ifc(file: UploadFile = File(...)):
     logger.info(f"Session ID: {session_id}")
     logger.info(f"File path: {file_path}")
     
+    size = 0
+    hasher = hashlib.sha256()
     async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        await f.write(content)
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+            hasher.update(chunk)
+            size += len(chunk)
+    file_hash = hasher.hexdigest()
+    
+    logger.info(f"File saved successfully, size: {size} bytes")
     
-    logger.info(f"File saved successfully, size: {len(content)} bytes")
+    # A byte-identical file was parsed before: hand out that session instead of parsing again
+    parsed_session_id = await find_parsed_upload(neo4j_service, UPLOAD_DIR, file_hash)
+    if parsed_session_id is not None:
+        file_path.unlink()
+        logger.info(f"Reusing session {parsed_session_id} for identical upload {file.filename}")
+        return StreamingResponse(
+            iter_geometry_response(UPLOAD_DIR, parsed_session_id, {"session_id": parsed_session_id}),
+            media_type="application/json"
+        )
     
     try:
         logger.info(f"Starting IFC parsing for session {session_id}")
-        geometry_data = parse_ifc_to_neo4j(str(file_path), session_id, neo4j_service)
+        # Parsing and ingestion are blocking, so keep them off the event loop.
+        # Meshes go straight to the session's geometry file and are streamed back from there
+        await asyncio.to_thread(
+            parse_ifc_to_neo4j, str(file_path), session_id, neo4j_service, str(geometry_path(UPLOAD_DIR, session_id))
+        )
+        invalidate_session_cache(session_id)
+        await record_parsed_upload(neo4j_service, session_id, file_hash)
         logger.info(f"IFC parsing completed successfully for session {session_id}")
-        return {
-            "session_id": session_id,
-            "geometry": geometry_data
-        }
+        return StreamingResponse(
+            iter_geometry_response(UPLOAD_DIR, session_id, {"session_id": session_id}),
+            media_type="application/json"
+        )
     except Exception as e:
         logger.error(f"IFC parsing failed for session {session_id}: {str(e)}")
         import traceback
@@ -176,130 +264,149 @@ async def upload_ifc(file: UploadFile = File(...)):
 
 
 @app.get("/geometry/{session_id}")
-async def get_geometry(session_id: str):
-    """Get 3D geometry data for visualization"""
+async def get_geometry(session_id: str, cursor: str = "", page_size: int = Query(500, ge=1, le=1000)):
+    """Stream one page of 3D geometry data for visualization as NDJSON.
+
+    Rows are ordered by guid; pass the last guid of a page as ``cursor`` to get the next one.
+    """
+    rows = neo4j_service.stream_query("""
+        MATCH (e:IfcNode) WHERE e.session_id = $session_id AND e.geometry IS NOT NULL AND e.guid > $cursor
+        RETURN e.type as element_type, e.name as name, e.guid as guid, 
+               e.geometry as geometry, e.material as material
+        ORDER BY e.guid
+        LIMIT $page_size
+    """, {"session_id": session_id, "cursor": cursor, "page_size": page_size}, fetch_size=page_size)
+    
+    # Pull the first row before the response starts, so a failing query is still a 500
     try:
-        # Get simplified geometry from Neo4j for 3D visualization
-        result = neo4j_service.execute_query("""
-            MATCH (e) WHERE e.session_id = $session_id AND e.geometry IS NOT NULL
-            RETURN e.type as element_type, e.name as name, e.guid as guid, 
-                   e.geometry as geometry, e.material as material
-            LIMIT 1000
-        """, {"session_id": session_id})
-        
-        return {"geometry_data": result}
+        first = await rows.__anext__()
+    except StopAsyncIteration:
+        first = None
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get geometry: {str(e)}")
+    
+    async def ndjson():
+        if first is None:
+            return
+        yield orjson.dumps(first) + b"\n"
+        async for row in rows:
+            yield orjson.dumps(row) + b"\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
 
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
+    # Only first-turn questions are cached; with history the answer depends on the conversation
+    cache_key = None if request.conversation_history else answer_cache_key(request.session_id, request.question)
+    if cache_key:
+        cached = await ANSWER_CACHE.get(cache_key)
+        if cached is not None:
+            CACHE_STATS["answers"]["hits"] += 1
+            return ChatResponse(**json.loads(cached))
+        CACHE_STATS["answers"]["misses"] += 1
     try:
-        # First check if it's a visual command
-        visual_command_result = await claude_service.parse_visual_command(request.question)
+        # Check for a visual command and generate the Cypher query concurrently
+        # The summary is only needed if the question reaches the LLM, so it is loaded on demand
+        visual_command_result, cypher_query = await claude_service.classify_and_generate(
+            request.question, request.session_id, partial(load_session_summary, request.session_id)
+        )
         
-        if visual_command_result.get("has_command"):
+        if isinstance(visual_command_result, dict) and visual_command_result.get("has_command"):
             # Return visual command with response
-            return ChatResponse(
+            response = ChatResponse(
                 response=visual_command_result.get("message", "ビジュアルコマンドを実行します"),
                 visual_command=visual_command_result.get("command")
             )
+            if cache_key:
+                await ANSWER_CACHE.set(cache_key, response.model_dump_json(), ttl=ANSWER_CACHE_TTL)
+            return response
         
         # If not a visual command, proceed with regular chat
-        # Generate Cypher query
-        cypher_query = await claude_service.generate_cypher(request.question, request.session_id)
+        if isinstance(cypher_query, Exception):
+            raise cypher_query
         
         # Execute the query
-        result = neo4j_service.execute_query(cypher_query, {"session_id": request.session_id})
+        result = await neo4j_service.execute_query_async(cypher_query, {"session_id": request.session_id})
         
         # Generate natural language response with conversation history
-        natural_response = await claude_service.generate_natural_response(
+        natural_response, complete = await claude_service.generate_natural_response(
             request.question, 
             result, 
-            request.conversation_history
+            request.conversation_history,
+            session_id=request.session_id
         )
         
-        return ChatResponse(response=natural_response, visual_command=None)
+        response = ChatResponse(response=natural_response, visual_command=None)
+        # Failed or truncated answers are never cached
+        if cache_key and complete:
+            await ANSWER_CACHE.set(cache_key, response.model_dump_json(), ttl=ANSWER_CACHE_TTL)
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Chat processing failed: {str(e)}")
 
 
-@app.get("/building-info/{session_id}")
-async def get_building_info(session_id: str):
-    """Get comprehensive building information summary"""
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Same as /chat, but streams the natural language answer as plain text.
+
+    Visual commands are still answered with a single ChatResponse JSON body.
+    If the answer breaks off after it has started, the body ends with STREAM_ERROR_MARKER.
+    """
     try:
-        # Get all available information from the database
-        info = {}
-        
-        # Building basic info
-        buildings = neo4j_service.execute_query("""
-            MATCH (b:IfcBuilding) WHERE b.session_id = $session_id 
-            RETURN b.name as name, b.description as description, b.guid as guid
-        """, {"session_id": session_id})
-        info["building"] = buildings[0] if buildings else None
-        
-        # Count of floors
-        floors = neo4j_service.execute_query("""
-            MATCH (s:IfcBuildingStorey) WHERE s.session_id = $session_id 
-            RETURN count(s) as count, collect(s.name) as names, collect(s.elevation) as elevations
-        """, {"session_id": session_id})
-        info["floors"] = floors[0] if floors else {"count": 0}
-        
-        # Count of spaces/rooms
-        spaces = neo4j_service.execute_query("""
-            MATCH (sp:IfcSpace) WHERE sp.session_id = $session_id 
-            RETURN count(sp) as count, collect(sp.name) as names
-        """, {"session_id": session_id})
-        info["spaces"] = spaces[0] if spaces else {"count": 0}
-        
-        # Count of windows
-        windows = neo4j_service.execute_query("""
-            MATCH (w:IfcWindow) WHERE w.session_id = $session_id 
-            RETURN count(w) as count
-        """, {"session_id": session_id})
-        info["windows"] = windows[0] if windows else {"count": 0}
-        
-        # Count of doors
-        doors = neo4j_service.execute_query("""
-            MATCH (d:IfcDoor) WHERE d.session_id = $session_id 
-            RETURN count(d) as count
-        """, {"session_id": session_id})
-        info["doors"] = doors[0] if doors else {"count": 0}
-        
-        # Count of structural elements
-        elements = neo4j_service.execute_query("""
-            MATCH (e:IfcBuildingElementProxy) WHERE e.session_id = $session_id 
-            RETURN count(e) as count
-        """, {"session_id": session_id})
-        info["structural_elements"] = elements[0] if elements else {"count": 0}
+        # The summary is only needed if the question reaches the LLM, so it is loaded on demand
+        visual_command_result, cypher_query = await claude_service.classify_and_generate(
+            request.question, request.session_id, partial(load_session_summary, request.session_id)
+        )
         
-        # All node types summary - use element_type when available, otherwise use primary label
-        node_types = neo4j_service.execute_query("""
-            MATCH (n) WHERE n.session_id = $session_id 
-            WITH n, 
-                 CASE 
-                     WHEN n.element_type IS NOT NULL THEN n.element_type
-                     ELSE labels(n)[0]
-                 END as element_type
-            RETURN element_type, count(n) as count 
-            ORDER BY count DESC
-        """, {"session_id": session_id})
+        if isinstance(visual_command_result, dict) and visual_command_result.get("has_command"):
+            return ChatResponse(
+                response=visual_command_result.get("message", "ビジュアルコマンドを実行します"),
+                visual_command=visual_command_result.get("command")
+            )
         
-        # Format the results to match the expected structure
-        formatted_elements = []
-        for item in node_types:
-            formatted_elements.append({
-                "labels": [item["element_type"]],
-                "count": item["count"]
-            })
-        info["all_elements"] = formatted_elements
+        if isinstance(cypher_query, Exception):
+            raise cypher_query
         
-        # Count of materials
-        materials = neo4j_service.execute_query("""
-            MATCH (m:IfcMaterial) WHERE m.session_id = $session_id 
-            RETURN count(m) as count, collect(m.name) as names
-        """, {"session_id": session_id})
-        info["materials"] = materials[0] if materials else {"count": 0, "names": []}
+        result = await neo4j_service.execute_query_async(cypher_query, {"session_id": request.session_id})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Chat processing failed: {str(e)}")
+    
+    async def answer():
+        try:
+            async for text in claude_service.stream_natural_response(
+                request.question, result, request.conversation_history, session_id=request.session_id
+            ):
+                yield text
+        except IncompleteResponseError:
+            # Cut off at max_tokens: the text so far is still the answer
+            pass
+        except Exception:
+            # The 200 status is already sent, so the failure is reported in the body
+            yield STREAM_ERROR_MARKER
+    
+    return StreamingResponse(answer(), media_type="text/plain; charset=utf-8")
+
+
+@app.get("/building-info/{session_id}")
+async def get_building_info(session_id: str):
+    """Get comprehensive building information summary"""
+    if session_id in BUILDING_INFO_CACHE:
+        CACHE_STATS["building_info"]["hits"] += 1
+        return BUILDING_INFO_CACHE[session_id]
+    CACHE_STATS["building_info"]["misses"] += 1
+    try:
+        # The summary is precomputed at parse time; sessions parsed before it
+        # existed fall back to aggregating the graph
+        rows = await neo4j_service.execute_query_async(
+            f"MATCH (m:{SESSION_LABEL} {{session_id: $session_id}}) RETURN m.building_info as building_info",
+            {"session_id": session_id}
+        )
+        if rows:
+            info = json.loads(rows[0]["building_info"])
+        else:
+            rows = await neo4j_service.execute_query_async(BUILDING_INFO_QUERY, {"session_id": session_id})
+            info = dict(rows[0])
         
         # Log material information for debugging
         import logging
@@ -315,12 +422,25 @@ async def get_building_info(session_id: str):
         
         # Remove capabilities analysis (not needed in UI anymore)
         
-        return {"session_id": session_id, "building_info": info}
+        response = {"session_id": session_id, "building_info": info}
+        # Don't cache a session whose parse hasn't written anything yet
+        if info.get("building") is not None:
+            BUILDING_INFO_CACHE[session_id] = response
+        return response
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get building info: {str(e)}")
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters and sizes of the per-session response caches"""
+    return {
+        "building_info": {**CACHE_STATS["building_info"], "size": len(BUILDING_INFO_CACHE)},
+        "answers": CACHE_STATS["answers"],
+    }
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
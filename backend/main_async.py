@@ -1,22 +1,35 @@
 from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
 import uuid
 import aiofiles
 from typing import Dict, Any, Optional
 import logging
 
 from neo4j_service import Neo4jService
-from ifc_parser import parse_ifc_to_neo4j
-from claude_service import ClaudeService
+import parse_worker
+from parsed_uploads import find_parsed_upload, geometry_path, iter_geometry_response, record_parsed_upload
+from claude_service import ClaudeService, close_http_client
 from pydantic import BaseModel
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS settings
 app.add_middleware(
@@ -26,6 +39,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # Initialize services
 neo4j_service = Neo4jService()
@@ -34,9 +48,64 @@ claude_service = ClaudeService()
 # Upload directory
 UPLOAD_DIR = Path("./uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+# Uploads are copied to disk in chunks of this size rather than read whole
+UPLOAD_CHUNK_SIZE = 1 << 20
 
-# In-memory status tracking (could use Redis in production)
+# Upload status lives in Redis when REDIS_URL is set, so every uvicorn worker
+# sees the same state; otherwise it falls back to this process's memory
+UPLOAD_STATUS_TTL = 3600
 upload_status: Dict[str, Dict[str, Any]] = {}
+redis_client = None
+if os.getenv("REDIS_URL"):
+    if aioredis is None:
+        logger.warning("REDIS_URL is set but redis is not installed; keeping upload status in memory")
+    else:
+        redis_client = aioredis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
+
+
+async def set_upload_status(session_id: str, status: Dict[str, Any]):
+    if redis_client is not None:
+        try:
+            await redis_client.set(f"upload:{session_id}", json.dumps(status), ex=UPLOAD_STATUS_TTL)
+            upload_status.pop(session_id, None)
+            return
+        except Exception as e:
+            logger.warning(f"Redis upload status write failed, keeping it in memory: {e}")
+    upload_status[session_id] = status
+
+
+async def load_upload_status(session_id: str) -> Optional[Dict[str, Any]]:
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(f"upload:{session_id}")
+            if raw:
+                return json.loads(raw)
+        except Exception as e:
+            logger.warning(f"Redis upload status read failed, using memory: {e}")
+    return upload_status.get(session_id)
+
+# Parsing is CPU-bound, so it runs in a process pool instead of on the event loop.
+# Every parse already tessellates on GEOMETRY_THREADS threads, so keep the pool small.
+# Workers are spawned rather than forked so they don't inherit this process's event
+# loop, drivers and HTTP client; parse_worker gives each one its own sync driver.
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
+
+
+@app.on_event("startup")
+async def startup_event():
+    neo4j_service.create_constraints()
+    app.state.parse_pool = ProcessPoolExecutor(
+        max_workers=PARSE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=parse_worker.init_worker
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.parse_pool.shutdown(wait=False)
+    await neo4j_service.aclose()
+    await close_http_client()
 
 class UploadStatus(BaseModel):
     session_id: str
@@ -46,36 +115,42 @@ class UploadStatus(BaseModel):
     geometry_data: Optional[dict] = None
     error: Optional[str] = None
 
-async def parse_ifc_background(file_path: Path, session_id: str, neo4j_service: Neo4jService):
-    """Background task to parse IFC file"""
+async def parse_ifc_background(file_path: Path, session_id: str, file_hash: str):
+    """Background task to parse IFC file in the parse pool"""
     try:
         # Update status to processing
-        upload_status[session_id] = {
+        await set_upload_status(session_id, {
             "status": "processing",
             "message": "Parsing IFC file...",
             "progress": 0
-        }
+        })
         
         # Parse IFC file
-        geometry_data = parse_ifc_to_neo4j(str(file_path), session_id, neo4j_service)
+        loop = asyncio.get_running_loop()
+        # The worker writes the meshes to the session's geometry file, so none come back through the pool
+        await loop.run_in_executor(
+            app.state.parse_pool, parse_worker.parse_in_worker, str(file_path), session_id,
+            str(geometry_path(UPLOAD_DIR, session_id))
+        )
+        
+        await record_parsed_upload(neo4j_service, session_id, file_hash)
         
         # Update status to completed
-        upload_status[session_id] = {
+        await set_upload_status(session_id, {
             "status": "completed",
             "message": "IFC file parsed successfully",
-            "progress": 100,
-            "geometry_data": geometry_data
-        }
+            "progress": 100
+        })
         
         logger.info(f"Successfully parsed IFC file for session {session_id}")
         
     except Exception as e:
         logger.error(f"Failed to parse IFC file for session {session_id}: {str(e)}")
-        upload_status[session_id] = {
+        await set_upload_status(session_id, {
             "status": "failed",
             "message": "Failed to parse IFC file",
             "error": str(e)
-        }
+        })
 
 @app.post("/upload_ifc")
 async def upload_ifc(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
@@ -89,23 +164,41 @@ async def upload_ifc(background_tasks: BackgroundTasks, file: UploadFile = File(
         file_path = UPLOAD_DIR / f"{session_id}_{file.filename}"
         
         # Save file asynchronously
+        hasher = hashlib.sha256()
         async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+                hasher.update(chunk)
+        file_hash = hasher.hexdigest()
+        
+        # A byte-identical file was parsed before: hand out that session instead of parsing again
+        parsed_session_id = await find_parsed_upload(neo4j_service, UPLOAD_DIR, file_hash)
+        if parsed_session_id is not None:
+            file_path.unlink()
+            await set_upload_status(parsed_session_id, {
+                "status": "completed",
+                "message": "IFC file parsed successfully",
+                "progress": 100
+            })
+            return {
+                "session_id": parsed_session_id,
+                "status": "completed",
+                "message": "File already parsed, reusing the existing session"
+            }
         
         # Initialize status
-        upload_status[session_id] = {
+        await set_upload_status(session_id, {
             "status": "queued",
             "message": "File uploaded, waiting to process...",
             "progress": 0
-        }
+        })
         
         # Add parsing task to background
         background_tasks.add_task(
             parse_ifc_background,
             file_path,
             session_id,
-            neo4j_service
+            file_hash
         )
         
         return {
@@ -121,20 +214,21 @@ async def upload_ifc(background_tasks: BackgroundTasks, file: UploadFile = File(
 @app.get("/upload-status/{session_id}")
 async def get_upload_status(session_id: str):
     """Get the status of an upload"""
-    if session_id not in upload_status:
+    status_data = await load_upload_status(session_id)
+    if status_data is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    status_data = upload_status[session_id].copy()
-    
-    # If completed, include geometry data
-    if status_data["status"] == "completed" and "geometry_data" in status_data:
-        return {
-            "session_id": session_id,
-            "status": status_data["status"],
-            "message": status_data["message"],
-            "progress": status_data["progress"],
-            "geometry": status_data["geometry_data"]
-        }
+    # If completed, include geometry data; it is kept once on disk rather than in every status
+    if status_data["status"] == "completed" and geometry_path(UPLOAD_DIR, session_id).exists():
+        return StreamingResponse(
+            iter_geometry_response(UPLOAD_DIR, session_id, {
+                "session_id": session_id,
+                "status": status_data["status"],
+                "message": status_data["message"],
+                "progress": status_data["progress"]
+            }),
+            media_type="application/json"
+        )
     else:
         return {
             "session_id": session_id,
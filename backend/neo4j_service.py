@@ -1,20 +1,67 @@
-from neo4j import GraphDatabase
+from neo4j import READ_ACCESS, AsyncGraphDatabase, GraphDatabase
 import os
 import logging
-from typing import List, Dict, Any
+from contextlib import contextmanager
+from typing import List, Dict, Any, AsyncIterator, Iterator
 
 logger = logging.getLogger(__name__)
 
 
+# Labels queried by session_id; IfcNode and IfcMaterial together cover every
+# node a parse creates, so "all nodes in a session" can seek instead of scan
+_SESSION_INDEXED_LABELS = [
+    "IfcNode", "IfcMaterial", "IfcElement", "IfcBuilding", "IfcBuildingStorey", "IfcSpace",
+    "IfcDoor", "IfcWindow", "IfcBuildingElementProxy", "IfcFurnishingElement",
+    "IfcWall", "IfcColumn", "IfcBeam", "IfcSlab", "IfcSession",
+]
+# Labels whose nodes are matched by (session_id, guid) while the parser links them
+_GUID_INDEXED_LABELS = [
+    "IfcNode", "IfcElement", "IfcBuilding", "IfcBuildingStorey", "IfcSpace",
+    "IfcDoor", "IfcWindow", "IfcBuildingElementProxy", "IfcFurnishingElement",
+]
+
+
+# Shared by both drivers: long-lived pooled connections so requests skip the
+# TCP/TLS handshake, and a short acquisition timeout so a saturated pool fails
+# fast instead of queueing requests
+_DRIVER_CONFIG = {
+    "max_connection_pool_size": 50,
+    "max_connection_lifetime": 3600,
+    "connection_acquisition_timeout": 5,
+    "keep_alive": True,
+    "fetch_size": 1000,
+}
+
+
+class Neo4jTransaction:
+    """Explicit transaction with the same execute_query interface as Neo4jService"""
+    
+    def __init__(self, tx):
+        self._tx = tx
+    
+    def execute_query(self, query: str, parameters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        result = self._tx.run(query, parameters or {})
+        return [dict(record) for record in result]
+
+
 class Neo4jService:
-    def __init__(self):
+    def __init__(self, use_async: bool = True):
         self.uri = os.getenv("NEO4J_URI", "bolt://localhost:7687")
         self.auth = tuple(os.getenv("NEO4J_AUTH", "neo4j/password123").split("/"))
-        self.driver = GraphDatabase.driver(self.uri, auth=self.auth)
+        # Sync driver for IFC ingestion, which runs outside the event loop
+        self.driver = GraphDatabase.driver(self.uri, auth=self.auth, **_DRIVER_CONFIG)
+        # Pooled async driver for request handlers, so queries don't block the event loop.
+        # Parse workers only ingest and go without it
+        self.async_driver = AsyncGraphDatabase.driver(self.uri, auth=self.auth, **_DRIVER_CONFIG) if use_async else None
     
     def close(self):
         self.driver.close()
     
+    async def aclose(self):
+        self.driver.close()
+        if self.async_driver is not None:
+            await self.async_driver.close()
+    
     def verify_connection(self):
         try:
             with self.driver.session() as session:
@@ -30,18 +77,57 @@ class Neo4jService:
             result = session.run(query, parameters or {})
             return [dict(record) for record in result]
     
+    async def execute_query_async(self, query: str, parameters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Execute a Cypher query on the async driver and return results"""
+        async with self.async_driver.session() as session:
+            result = await session.run(query, parameters or {})
+            return [dict(record) async for record in result]
+    
+    async def stream_query(self, query: str, parameters: Dict[str, Any] = None,
+                           fetch_size: int = 1000) -> AsyncIterator[Dict[str, Any]]:
+        """Execute a read-only Cypher query on the async driver and yield records as they arrive,
+        pulling ``fetch_size`` records per round trip"""
+        async with self.async_driver.session(default_access_mode=READ_ACCESS, fetch_size=fetch_size) as session:
+            result = await session.run(query, parameters or {})
+            async for record in result:
+                yield dict(record)
+    
+    @contextmanager
+    def transaction(self) -> Iterator[Neo4jTransaction]:
+        """Run several queries in one transaction, committed on exit and rolled back on error"""
+        with self.driver.session() as session:
+            with session.begin_transaction() as tx:
+                yield Neo4jTransaction(tx)
+                tx.commit()
+    
+    def has_procedure(self, name: str) -> bool:
+        """Whether a procedure such as apoc.create.node is installed"""
+        try:
+            result = self.execute_query(
+                "SHOW PROCEDURES YIELD name WHERE name = $name RETURN count(*) AS count",
+                {"name": name}
+            )
+            return bool(result and result[0]["count"])
+        except Exception as e:
+            logger.warning(f"Could not list procedures: {e}")
+            return False
+    
     def create_constraints(self):
-        """Create necessary constraints and indexes"""
+        """Create every index the app relies on; run once at startup.
+
+        guid is only unique within a session (the same file can be uploaded twice),
+        so it is not constrained globally.
+        """
         constraints = [
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (b:IfcBuilding) REQUIRE b.guid IS UNIQUE",
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (s:IfcBuildingStorey) REQUIRE s.guid IS UNIQUE",
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (sp:IfcSpace) REQUIRE sp.guid IS UNIQUE",
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (d:IfcDoor) REQUIRE d.guid IS UNIQUE",
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (w:IfcWindow) REQUIRE w.guid IS UNIQUE",
-            "CREATE INDEX IF NOT EXISTS FOR (n:IfcBuilding) ON (n.session_id)",
-            "CREATE INDEX IF NOT EXISTS FOR (n:IfcBuildingStorey) ON (n.session_id)",
-            "CREATE INDEX IF NOT EXISTS FOR (n:IfcSpace) ON (n.session_id)",
+            f"CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.session_id)"
+            for label in _SESSION_INDEXED_LABELS
+        ]
+        constraints += [
+            f"CREATE INDEX {label.lower()}_session_guid IF NOT EXISTS FOR (n:{label}) ON (n.session_id, n.guid)"
+            for label in _GUID_INDEXED_LABELS
         ]
+        # Content hash of the uploaded file, used to reuse a parsed session
+        constraints.append("CREATE INDEX IF NOT EXISTS FOR (n:IfcSession) ON (n.file_hash)")
         
         with self.driver.session() as session:
             for constraint in constraints:
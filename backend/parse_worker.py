@@ -0,0 +1,20 @@
+from typing import Optional
+
+from ifc_parser import parse_ifc_to_neo4j
+from neo4j_service import Neo4jService
+
+# Entry points for main_async's parse pool. They live apart from the app module so
+# a spawned worker imports only the parser, not the API's services and clients.
+
+# This process's Neo4j connection, opened once by init_worker. Ingestion only
+# uses the sync driver, so the async one is never created.
+_neo4j_service: Optional[Neo4jService] = None
+
+
+def init_worker():
+    global _neo4j_service
+    _neo4j_service = Neo4jService(use_async=False)
+
+
+def parse_in_worker(file_path: str, session_id: str, geometry_file: str) -> int:
+    return parse_ifc_to_neo4j(file_path, session_id, _neo4j_service, geometry_file)
@@ -0,0 +1,46 @@
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional
+
+import aiofiles
+import orjson
+
+from ifc_parser import SESSION_LABEL
+
+# Stored geometry is sent to the client in chunks of this size rather than read whole
+GEOMETRY_CHUNK_SIZE = 1 << 20
+
+
+def geometry_path(upload_dir: Path, session_id: str) -> Path:
+    """Where parse_ifc_to_neo4j writes a session's meshes as a JSON array"""
+    return upload_dir / f"{session_id}_geometry.json"
+
+
+async def iter_geometry_response(upload_dir: Path, session_id: str, fields: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """Yield a JSON object of ``fields`` plus the session's stored meshes under "geometry".
+
+    The meshes are copied from disk in chunks, so they are never parsed or held whole.
+    """
+    yield orjson.dumps(fields)[:-1] + b',"geometry":'
+    async with aiofiles.open(geometry_path(upload_dir, session_id), 'rb') as f:
+        while chunk := await f.read(GEOMETRY_CHUNK_SIZE):
+            yield chunk
+    yield b"}"
+
+
+async def find_parsed_upload(neo4j_service, upload_dir: Path, file_hash: str) -> Optional[str]:
+    """Return the session_id of an earlier parse of the same file whose geometry is still stored, or None"""
+    rows = await neo4j_service.execute_query_async(
+        f"MATCH (m:{SESSION_LABEL} {{file_hash: $file_hash}}) RETURN m.session_id as session_id LIMIT 1",
+        {"file_hash": file_hash}
+    )
+    if not rows or not geometry_path(upload_dir, rows[0]["session_id"]).exists():
+        return None
+    return rows[0]["session_id"]
+
+
+async def record_parsed_upload(neo4j_service, session_id: str, file_hash: str):
+    """Keep the upload's content hash so identical uploads can reuse this session"""
+    await neo4j_service.execute_query_async(
+        f"MATCH (m:{SESSION_LABEL} {{session_id: $session_id}}) SET m.file_hash = $file_hash",
+        {"session_id": session_id, "file_hash": file_hash}
+    )
@@ -0,0 +1,36 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("anthropic")
+pytest.importorskip("httpx")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import claude_service  # noqa: E402
+
+
+ROOM_QUERY = (
+    "MATCH (s:IfcBuildingStorey)-[:CONTAINS_SPACE]->(sp:IfcSpace) "
+    "WHERE s.session_id = $session_id AND (s.name CONTAINS '2' OR s.elevation > 0) "
+    "RETURN count(sp) as room_count"
+)
+
+
+def test_room_question_is_not_swappable():
+    assert claude_service._cypher_skeleton("2階の部屋の数は？") is None
+
+
+def test_room_template_is_not_reused_for_windows():
+    # A traversal is never templated, so a window question can't inherit the CONTAINS_SPACE path
+    assert claude_service._cypher_template(ROOM_QUERY.replace("IfcSpace", "IfcWindow"), "窓") is None
+
+
+def test_flat_query_is_templated_and_filled():
+    query = "MATCH (w:IfcWindow) WHERE w.session_id = $session_id RETURN count(w) as window_count"
+    template = claude_service._cypher_template(query, "窓")
+    assert template is not None
+    assert claude_service._fill_cypher_template(template, "ドア") == (
+        "MATCH (w:IfcDoor) WHERE w.session_id = $session_id RETURN count(w) as door_count"
+    )
@@ -5,7 +5,7 @@ LargeBuilding.ifcファイルに含まれるIFC要素タイプを調査するス
 
 import ifcopenshell
 import os
-from collections import Counter
+from collections import Counter, defaultdict
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
 
@@ -21,10 +21,11 @@ def analyze_ifc_file(file_path):
         # 全ての要素を取得
         all_elements = ifc_file.by_type("IfcProduct")
         
-        # 要素タイプごとにカウント
-        element_types = Counter()
+        # 要素タイプごとに振り分け（1回の走査でカウントと具体例の両方に使う）
+        buckets = defaultdict(list)
         for element in all_elements:
-            element_types[element.is_a()] += 1
+            buckets[element.is_a()].append(element)
+        element_types = Counter({element_type: len(elements) for element_type, elements in buckets.items()})
         
         # 結果を表示
         print(f"\n総要素数: {len(all_elements)}")
@@ -67,14 +68,12 @@ def analyze_ifc_file(file_path):
         print("各要素タイプの具体例:")
         print("-" * 50)
         
-        for element_type in sorted(element_types.keys()):
-            examples = ifc_file.by_type(element_type)[:3]  # 最初の3つの例
-            if examples:
-                print(f"\n{element_type}:")
-                for i, example in enumerate(examples, 1):
-                    name = getattr(example, 'Name', 'N/A') or 'N/A'
-                    desc = getattr(example, 'Description', 'N/A') or 'N/A'
-                    print(f"  例{i}: Name='{name}', Description='{desc}'")
+        for element_type, elements in sorted(buckets.items()):
+            print(f"\n{element_type}:")
+            for i, example in enumerate(elements[:3], 1):  # 最初の3つの例
+                name = getattr(example, 'Name', 'N/A') or 'N/A'
+                desc = getattr(example, 'Description', 'N/A') or 'N/A'
+                print(f"  例{i}: Name='{name}', Description='{desc}'")
         
     except Exception as e:
         print(f"Error analyzing IFC file: {e}")